@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# timed scenarios for fetch_posts.py, the markov model, gen.py and reply.py, run against fake_instance.py and
+# synthetic posts DBs instead of real instances. results are JSON, so that runs on different commits can be compared.
+
+import os
+import sys
+import json
+import time
+import anyio
+import random
+import shutil
+import signal
+import schema
+import platform
+import argparse
+import contextlib
+import tempfile
+import subprocess
+import json5
+from pathlib import Path
+from fake_instance import FakeInstance
+from third_party import utils
+
+REPO = Path(__file__).parent
+SCENARIOS = ['crawl', 'incremental', 'model_build', 'generate', 'reply_burst', 'startup']
+# how long any one script may take before the scenario is considered hung
+SCRIPT_TIMEOUT = 30 * 60
+CORPUS_BATCH_SIZE = 100_000
+CORPUS_VOCABULARY_SIZE = 20_000
+# how long gen.py may take to import, and to post from being started by cron. see the startup scenario.
+IMPORT_BUDGET_MS = 250
+POST_BUDGET_SECONDS = 2
+SYLLABLES = 'ba be bi bo bu ka ke ki ko ku la le li lo lu ma me mi mo mu na ne ni no nu ra re ri ro ru sa se si so su ta te ti to tu'.split()
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Benchmark pleroma-ebooks against a fake local instance.')
+	parser.add_argument(
+		'scenarios', nargs='*', metavar='scenario', default=SCENARIOS,
+		help='Which scenarios to run, out of: ' + ', '.join(SCENARIOS) + '. Defaults to all of them.',
+	)
+	parser.add_argument(
+		'-o', '--output',
+		help='Append the results as a line of JSON to this file, instead of printing them.',
+	)
+	parser.add_argument(
+		'--data-dir',
+		help='Keep synthetic corpora here, so that later runs can reuse them. Defaults to a temporary directory.',
+	)
+	parser.add_argument(
+		'--set', dest='overrides', action='append', default=[], metavar='KEY=VALUE',
+		help='Override a config value for every scenario. VALUE is JSON, e.g. --set markov_backend=\'"compact"\'',
+	)
+	parser.add_argument('--port', type=int, default=8700, help='Port for the fake instance.')
+	group = parser.add_argument_group('crawl and incremental')
+	group.add_argument('--users', type=int, default=50, help='How many accounts the bot follows.')
+	group.add_argument('--posts-per-user', type=int, default=200)
+	group.add_argument('--instances', type=int, default=5, help='How many instances the accounts are spread over.')
+	group.add_argument('--page-size', type=int, default=20, help='How many posts there are per outbox page.')
+	group.add_argument('--latency', type=float, default=0.02, help='Seconds the fake instance waits before responding.')
+	group.add_argument(
+		'--rate-limit', type=float,
+		help='Requests per second each fake instance allows before answering 429. Unlimited by default.',
+	)
+	group.add_argument('--new-posts', type=int, default=20, help='How many posts each account makes before the incremental sync.')
+	group = parser.add_argument_group('model_build, generate, reply_burst and startup')
+	group.add_argument(
+		'--corpus-size', type=int, action='append', metavar='POSTS',
+		help='Build the model from a synthetic corpus of this many posts. Repeat for several sizes. Defaults to 10000.',
+	)
+	group.add_argument('--sentences', type=int, default=200, help='How many sentences to time in-process generation over.')
+	group.add_argument('--runs', type=int, default=5, help='How many times to run gen.py.')
+	group.add_argument('--mentions', type=int, default=50, help='How many mentions to send reply.py at once.')
+	group = parser.add_argument_group('startup budgets')
+	group.add_argument(
+		'--import-budget', type=float, default=IMPORT_BUDGET_MS, metavar='MS',
+		help='How many milliseconds importing gen.py may take. Defaults to %(default)s.',
+	)
+	group.add_argument(
+		'--post-budget', type=float, default=POST_BUDGET_SECONDS, metavar='SECONDS',
+		help='How many seconds gen.py may take to post, from being started by cron. Defaults to %(default)s.',
+	)
+	group.add_argument(
+		'--check', action='store_true',
+		help='Exit with status 1 if the slowest startup run was over either budget, e.g. to catch regressions in CI.',
+	)
+	args = parser.parse_args()
+
+	if unknown := set(args.scenarios) - set(SCENARIOS):
+		parser.error('Unknown scenarios: ' + ', '.join(sorted(unknown)))
+	args.corpus_size = args.corpus_size or [10_000]
+	try:
+		args.overrides = {
+			key: json.loads(value)
+			for key, _, value in (override.partition('=') for override in args.overrides)
+		}
+	except json.JSONDecodeError as exc:
+		parser.error(f'--set values must be JSON: {exc}')
+	return args
+
+def summary(values):
+	"""min, mean, max and a couple of percentiles of values"""
+	values = sorted(values)
+	if not values:
+		return None
+	def percentile(p): return values[min(len(values) - 1, int(p / 100 * len(values)))]
+	return dict(
+		min=values[0],
+		p50=percentile(50),
+		p95=percentile(95),
+		max=values[-1],
+		mean=sum(values) / len(values),
+	)
+
+def git_revision():
+	try:
+		commit = subprocess.run(
+			['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True,
+		).stdout.strip()
+		dirty = bool(subprocess.run(
+			['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO, capture_output=True, text=True, check=True,
+		).stdout.strip())
+	except (OSError, subprocess.CalledProcessError):
+		return None, None
+	return commit, dirty
+
+def make_corpus(path, n, *, seed=0):
+	"""write a posts DB of n made up posts to path, with word frequencies roughly like real text"""
+	rand = random.Random(seed)
+	vocabulary = list({
+		''.join(rand.choices(SYLLABLES, k=rand.randint(1, 4))) for _ in range(CORPUS_VOCABULARY_SIZE)
+	})
+	# Zipf's law: the k'th most common word is k times rarer than the most common one
+	cum_weights = []
+	total = 0
+	for rank in range(1, len(vocabulary) + 1):
+		total += 1 / rank
+		cum_weights.append(total)
+
+	tmp_path = path.with_suffix('.tmp')
+	tmp_path.unlink(missing_ok=True)
+	db = schema.connect(str(tmp_path))
+	now = time.time()
+	try:
+		with db:
+			for start in range(0, n, CORPUS_BATCH_SIZE):
+				size = min(CORPUS_BATCH_SIZE, n - start)
+				lengths = [rand.randint(3, 40) for _ in range(size)]
+				words = iter(rand.choices(vocabulary, cum_weights=cum_weights, k=sum(lengths)))
+				db.executemany(
+					'INSERT INTO posts (post_id, summary, content, published_at) VALUES (?, ?, ?, ?)',
+					(
+						(
+							f'https://bench.invalid/objects/{start + i}',
+							# a few posts have CWs, so that learnable matters
+							'cw' if rand.random() < 0.05 else None,
+							' '.join(next(words) for _ in range(length)) + '.',
+							# about three years of posts, oldest first
+							now - (n - start - i) * (3 * 365 * 24 * 60 * 60 / n),
+						)
+						for i, length in enumerate(lengths)
+					),
+				)
+	finally:
+		db.close()
+	tmp_path.rename(path)
+
+async def import_seconds(module):
+	"""how long importing module takes in a fresh interpreter, according to -X importtime"""
+	proc = await anyio.run_process(
+		[sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=REPO, check=True,
+	)
+	for line in proc.stderr.decode().splitlines():
+		# import time: self [us] | cumulative | imported package
+		_, _, fields = line.partition('import time:')
+		self_us, cumulative_us, name = (field.strip() for field in fields.split('|'))
+		if name == module:
+			return int(cumulative_us) / 1_000_000
+	raise RuntimeError(f'{module} was not imported')
+
+@contextlib.contextmanager
+def data_directory(path):
+	"""path, created if necessary, or a temporary directory if path is None"""
+	if path is None:
+		with tempfile.TemporaryDirectory() as tmp:
+			yield Path(tmp)
+		return
+	path = Path(path)
+	path.mkdir(parents=True, exist_ok=True)
+	yield path
+
+class Bench:
+	def __init__(self, args):
+		self.args = args
+		self.results = {}
+
+	async def run(self):
+		with data_directory(self.args.data_dir) as self.data_dir, tempfile.TemporaryDirectory() as work_dir:
+			self.work_dir = Path(work_dir)
+			shutil.copy(REPO / 'config.defaults.json', self.work_dir)
+			for scenario in SCENARIOS:
+				if scenario in self.args.scenarios:
+					print('Running', scenario, file=sys.stderr)
+					self.results[scenario] = await getattr(self, scenario)()
+
+		commit, dirty = git_revision()
+		return dict(
+			commit=commit,
+			dirty=dirty,
+			time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+			python=platform.python_version(),
+			platform=platform.platform(),
+			cpus=os.cpu_count(),
+			options={key: value for key, value in vars(self.args).items() if key not in {'output', 'data_dir', 'port'}},
+			scenarios=self.results,
+		)
+
+	def config(self, **kwargs):
+		"""the config every scenario uses, plus kwargs"""
+		return {'access_token': 'bench', **kwargs, **self.args.overrides}
+
+	def write_config(self, **kwargs):
+		with open(self.work_dir / 'config.json', 'w') as f:
+			json.dump(self.config(**kwargs), f)
+
+	def load_config(self, **kwargs):
+		"""the config the scripts would see, for running things in this process"""
+		with open(REPO / 'config.defaults.json') as f:
+			cfg = json5.load(f)
+		cfg.update(self.config(**kwargs))
+		cfg['generation_mode'] = utils.TextGenerationMode.__members__[cfg['generation_mode']]
+		return cfg
+
+	async def run_script(self, script, *args):
+		"""run one of the repo's scripts in the work directory, returning how many seconds it took"""
+		start = time.perf_counter()
+		with anyio.fail_after(SCRIPT_TIMEOUT):
+			proc = await anyio.run_process(
+				[sys.executable, str(REPO / script), '-c', 'config.json', *args],
+				cwd=self.work_dir,
+				check=False,
+			)
+		elapsed = time.perf_counter() - start
+		if proc.returncode:
+			sys.stderr.buffer.write(proc.stdout + proc.stderr)
+			raise RuntimeError(f'{script} exited with status {proc.returncode}')
+		return elapsed
+
+	def fake_instance(self):
+		return FakeInstance(
+			port=self.args.port,
+			users=self.args.users,
+			posts_per_user=self.args.posts_per_user,
+			instances=self.args.instances,
+			page_size=self.args.page_size,
+			latency=self.args.latency,
+			rate_limit=self.args.rate_limit,
+		)
+
+	def post_count(self, db_path):
+		db = schema.connect(str(db_path))
+		try:
+			return db.execute('SELECT count(*) FROM posts').fetchone()[0]
+		finally:
+			db.close()
+
+	async def corpus(self, n):
+		"""return the path to a synthetic corpus of n posts with an up to date markov model, making them if necessary"""
+		path = self.data_dir / f'corpus-{n}.db'
+		if not path.exists():
+			print('Making a corpus of', n, 'posts', file=sys.stderr)
+			await anyio.to_thread.run_sync(make_corpus, path, n)
+		from generators import markov
+		await anyio.to_thread.run_sync(markov.update_model, self.load_config(db_path=str(path)))
+		return path
+
+	async def crawl(self):
+		db_path = self.work_dir / 'crawl.db'
+		async with self.fake_instance() as instance:
+			self.write_config(site=instance.site, db_path=str(db_path))
+			seconds = await self.run_script('fetch_posts.py')
+		posts = self.post_count(db_path)
+		return dict(
+			seconds=seconds,
+			posts=posts,
+			posts_per_second=posts / seconds,
+			requests=sum(count for key, count in instance.requests.items() if isinstance(key, tuple)),
+			rate_limited=instance.requests['rate_limited'],
+		)
+
+	async def incremental(self):
+		db_path = self.work_dir / 'crawl.db'
+		async with self.fake_instance() as instance:
+			self.write_config(site=instance.site, db_path=str(db_path))
+			if not db_path.exists():
+				await self.run_script('fetch_posts.py')
+			before = self.post_count(db_path)
+			instance.add_posts(self.args.new_posts)
+			instance.requests.clear()
+			seconds = await self.run_script('fetch_posts.py')
+		return dict(
+			seconds=seconds,
+			new_posts=self.post_count(db_path) - before,
+			requests=sum(count for key, count in instance.requests.items() if isinstance(key, tuple)),
+			outbox_requests=instance.requests['GET', 'outbox'],
+			not_modified=instance.requests['not_modified'],
+			rate_limited=instance.requests['rate_limited'],
+		)
+
+	async def model_build(self):
+		from generators import markov
+		results = {}
+		for n in self.args.corpus_size:
+			path = self.data_dir / f'corpus-{n}.db'
+			if not path.exists():
+				print('Making a corpus of', n, 'posts', file=sys.stderr)
+				await anyio.to_thread.run_sync(make_corpus, path, n)
+			cfg = self.load_config(db_path=str(path))
+			start = time.perf_counter()
+			await anyio.to_thread.run_sync(lambda: markov.update_model(cfg, rebuild=True))
+			build_seconds = time.perf_counter() - start
+
+			start = time.perf_counter()
+			await anyio.to_thread.run_sync(markov.load_model, cfg)
+			load_seconds = time.perf_counter() - start
+			results[n] = dict(
+				build_seconds=build_seconds,
+				load_seconds=load_seconds,
+				model_bytes=os.path.getsize(markov.model_path(cfg)),
+			)
+		return results
+
+	async def generate(self):
+		from generators import markov
+		path = await self.corpus(min(self.args.corpus_size))
+		cfg = self.load_config(db_path=str(path))
+		self.write_config(site='http://127.0.0.1', db_path=str(path))
+
+		# what a cron job posting every so often pays, model loading and all
+		runs = [await self.run_script('gen.py', '--simulate') for _ in range(self.args.runs)]
+
+		markov.warm_up(cfg)
+		markov.stats.__init__()
+		latencies = []
+		for _ in range(self.args.sentences):
+			start = time.perf_counter()
+			markov.make_sentence(cfg)
+			latencies.append((time.perf_counter() - start) * 1000)
+		return dict(
+			gen_py_seconds=summary(runs),
+			sentence_ms=summary(latencies),
+			generation=markov.stats.as_dict(),
+		)
+
+	async def reply_burst(self):
+		path = await self.corpus(min(self.args.corpus_size))
+		async with self.fake_instance() as instance:
+			self.write_config(site=instance.site, db_path=str(path))
+			start = time.perf_counter()
+			proc = await anyio.open_process(
+				[sys.executable, str(REPO / 'reply.py'), '-c', 'config.json'],
+				cwd=self.work_dir,
+				stdout=subprocess.DEVNULL,
+				stderr=subprocess.DEVNULL,
+			)
+			try:
+				with anyio.fail_after(SCRIPT_TIMEOUT):
+					await instance.wait_for_stream()
+					startup_seconds = time.perf_counter() - start
+					start = time.perf_counter()
+					for i in range(self.args.mentions):
+						await instance.mention(f'hi {i}')
+					await instance.replied.wait()
+					seconds = time.perf_counter() - start
+			finally:
+				proc.send_signal(signal.SIGINT)
+				with anyio.move_on_after(10):
+					await proc.wait()
+				if proc.returncode is None:
+					proc.kill()
+				await proc.aclose()
+
+		latencies = [
+			(instance.replied_at[id] - mentioned_at) * 1000
+			for id, mentioned_at in instance.mentioned_at.items()
+		]
+		return dict(
+			startup_seconds=startup_seconds,
+			seconds=seconds,
+			replies_per_second=self.args.mentions / seconds,
+			latency_ms=summary(latencies),
+			context_requests=instance.requests['GET', 'context'],
+		)
+
+	async def startup(self):
+		path = await self.corpus(min(self.args.corpus_size))
+		imports = [await import_seconds('gen') for _ in range(self.args.runs)]
+
+		# what cron sees: from starting gen.py to the status being posted, with nothing buffered or preloaded
+		runs = []
+		async with self.fake_instance() as instance:
+			self.write_config(site=instance.site, db_path=str(path), post_buffer_size=0)
+			for _ in range(self.args.runs):
+				posted = len(instance.statuses)
+				runs.append(await self.run_script('gen.py'))
+				if len(instance.statuses) != posted + 1:
+					raise RuntimeError('gen.py exited without posting')
+
+		over_budget = []
+		if max(imports) * 1000 > self.args.import_budget:
+			over_budget.append('import')
+		if max(runs) > self.args.post_budget:
+			over_budget.append('post')
+		return dict(
+			import_seconds=summary(imports),
+			post_seconds=summary(runs),
+			import_budget_ms=self.args.import_budget,
+			post_budget_seconds=self.args.post_budget,
+			over_budget=over_budget,
+		)
+
+async def amain():
+	args = parse_args()
+	results = await Bench(args).run()
+	if args.output is None:
+		print(json.dumps(results, indent='\t'))
+	else:
+		with open(args.output, 'a') as f:
+			print(json.dumps(results), file=f)
+
+	if args.check and (over_budget := results['scenarios'].get('startup', {}).get('over_budget')):
+		print('Over budget:', ', '.join(over_budget), file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == '__main__':
+	anyio.run(amain)
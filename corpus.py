@@ -0,0 +1,109 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# choosing which posts to learn from.
+# whether a post may be learned from at all is worked out ahead of time and stored in posts.learnable.
+# sampling probes random rowids and keeps the learnable ones, so it takes time proportional to the size of the sample
+# rather than the size of the posts table.
+
+import json
+import math
+import heapq
+import random
+
+# how many rowids to look up per query. well under SQLite's limit on the number of parameters.
+PROBE_BATCH_SIZE = 500
+# give up on probing after this many probes per post wanted, and after this many probes per row in the table.
+# at that point, so few posts qualify that going through all of them is quicker.
+MAX_PROBES_PER_POST = 50
+MAX_PROBES_PER_ROW = 3
+# when preferring newer posts, posts more than this many half lives older than the newest one have a weight of less
+# than one in a million, so they're left out instead of being gone through
+MAX_HALF_LIVES = 20
+
+def learnable_settings(cfg):
+	"""the config values that decide which posts are learnable"""
+	return dict(
+		learn_from_cw=cfg['learn_from_cw'],
+		ignored_cws=sorted(cfg['ignored_cws']) if cfg['learn_from_cw'] else [],
+	)
+
+def _learnable_expression(cfg):
+	if cfg['learn_from_cw']:
+		ignored_cws_query_params = "(" + ",".join("?" * len(cfg["ignored_cws"])) + ")"
+		return f'summary IS NULL OR summary NOT IN {ignored_cws_query_params}', list(cfg['ignored_cws'])
+	return 'summary IS NULL', []
+
+def update_learnable(cfg, db):
+	"""Work out posts.learnable for every post that needs it, returning how many posts were updated.
+
+	Normally that's only the posts added since the last time, but if the settings changed, it's all of them.
+	"""
+	settings = json.dumps(learnable_settings(cfg), sort_keys=True)
+	expression, params = _learnable_expression(cfg)
+	with db:
+		row = db.execute("SELECT value FROM meta WHERE key = 'learnable_settings'").fetchone()
+		if row is not None and row[0] == settings:
+			where = 'WHERE learnable IS NULL'
+		else:
+			where = ''
+			db.execute("REPLACE INTO meta (key, value) VALUES ('learnable_settings', ?)", (settings,))
+		return db.execute(f'UPDATE posts SET learnable = ({expression}) {where}', params).rowcount
+
+def _weight(published_at, newest, half_life):
+	return 0.5 ** ((newest - published_at) / half_life)
+
+def sample(db, n, *, half_life=None):
+	"""Return the content of up to n different learnable posts, chosen at random.
+
+	If half_life (in seconds) is passed, newer posts are preferred:
+	a post half_life older than the newest learnable post is half as likely to be chosen.
+	posts.learnable must be up to date; see update_learnable.
+	"""
+	max_rowid, = db.execute('SELECT max(rowid) FROM posts').fetchone()
+	newest, = db.execute('SELECT max(published_at) FROM posts WHERE learnable = 1').fetchone()
+	if newest is None:
+		return []
+
+	chosen = {}
+	probes = 0
+	max_probes = min(MAX_PROBES_PER_POST * n, MAX_PROBES_PER_ROW * max_rowid)
+	while len(chosen) < n:
+		if probes >= max_probes:
+			return _sample_all(db, n, newest=newest, half_life=half_life)
+
+		rowids = [random.randint(1, max_rowid) for _ in range(PROBE_BATCH_SIZE)]
+		probes += len(rowids)
+		# the + keeps SQLite from using the learnable index, which would mean going through every learnable post
+		for rowid, content, published_at in db.execute(
+			f"""
+			SELECT rowid, content, published_at
+			FROM posts
+			WHERE rowid IN ({", ".join("?" * len(rowids))}) AND +learnable = 1
+			""",
+			rowids,
+		):
+			# rejection sampling, which keeps the chance of each post being chosen proportional to its weight
+			if half_life is None or random.random() < _weight(published_at, newest, half_life):
+				chosen[rowid] = content
+
+	return list(chosen.values())[:n]
+
+def _sample_all(db, n, *, newest, half_life):
+	"""sample by going through every learnable post, for when too few posts are learnable for probing to work"""
+	if half_life is None:
+		return [content for content, in db.execute(
+			'SELECT content FROM posts WHERE learnable = 1 ORDER BY random() LIMIT ?',
+			(n,),
+		)]
+
+	# weighted sampling without replacement: the n posts with the smallest exponentially distributed keys,
+	# where each key's rate is the post's weight (Efraimidis and Spirakis).
+	# the keys are compared as logarithms, since old enough posts' weights round down to 0.
+	return [content for content, _ in heapq.nsmallest(
+		n,
+		db.execute(
+			'SELECT content, published_at FROM posts WHERE learnable = 1 AND published_at >= ?',
+			(newest - MAX_HALF_LIVES * half_life,),
+		),
+		key=lambda row: math.log(random.expovariate(1)) + (newest - row[1]) / half_life * math.log(2),
+	)]
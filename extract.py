@@ -0,0 +1,203 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# turning post HTML into text, off of the event loop.
+# third_party.utils.extract_post_content is the reference implementation. extract_post_content_fast does the same
+# thing with a streaming tokenizer, without building a tree, and only handles the tags that Pleroma and Mastodon emit.
+
+import json
+import zlib
+import html
+import html.parser
+import pendulum
+
+# representative post HTML from Pleroma, Mastodon, and friends.
+# the fast path is only used if it agrees with the reference implementation on every one of these.
+FIXTURES = (
+	'',
+	'plain text, no markup at all',
+	'<p>hello world</p>',
+	'<p>first paragraph</p><p>second paragraph</p>',
+	'line one<br>line two<br/>line three<br />',
+	'<p>line one<br>line two</p><p>new paragraph</p>',
+	'<p>unclosed paragraph<p>another one',
+	'<p>nested <p>paragraphs</p> are weird</p>',
+	'&lt;not a tag&gt; &amp; friends &quot;quoted&quot; &#39;single&#39; &#x1F60A; &nbsp;nbsp',
+	'unknown &entity; and a lone & ampersand',
+	'&#150; windows-1252 dash, &#0; nul, &#xFFFFFFF; too big',
+	'<p><span class="h-card"><a class="u-url mention" href="https://example.com/@alice">'
+		'@<span>alice</span></a></span> hi!</p>',
+	'<span class="h-card"><a data-user="9zX" class="u-url mention" href="https://pleroma.example/users/bob" '
+		'rel="ugc">@<span>bob</span></a></span> what do you think',
+	'<p>tagged <a href="https://example.com/tags/cats" class="mention hashtag" rel="tag">#<span>cats</span></a></p>',
+	'<p>check out <a href="https://example.com/some/long/path" rel="nofollow noopener noreferrer" target="_blank">'
+		'<span class="invisible">https://</span><span class="ellipsis">example.com/some/long</span>'
+		'<span class="invisible">/path</span></a></p>',
+	'<a href="https://example.com">custom link text</a> and <a>a link without a href</a>',
+	'<p>emoji <img class="emoji" alt=":blobcat:" title=":blobcat:" src="https://example.com/blobcat.png"> here</p>',
+	'<p><strong>bold</strong> <em>italic</em> <del>struck</del> <code>code()</code></p>',
+	'<pre><code>def f():\n\treturn 1\n</code></pre>',
+	'<blockquote><p>quoted</p></blockquote><p>reply</p>',
+	'<ul><li>one</li><li>two</li></ul>',
+	'<p>trailing whitespace   </p>\n\n',
+	'<!-- a comment --><p>after the comment</p>',
+	'<p>RE: <a href="https://example.com/notice/abc">https://example.com/notice/abc</a></p>',
+	'<p>ünïcödé ✨ 日本語 <span lang="ja">テスト</span></p>',
+)
+
+# bs4 only considers these to be whitespace
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+PRESERVE_WHITESPACE = frozenset({'pre', 'textarea'})
+
+class _PostTextParser(html.parser.HTMLParser):
+	# elements that never have an end tag, so they're never open. this list is the same as bs4's.
+	VOID = frozenset(
+		'area base br col embed hr img input keygen link menuitem meta param source track wbr '
+		'basefont bgsound command frame image isindex nextid spacer'.split()
+	)
+	# elements whose text bs4 doesn't consider part of the document's text
+	SKIPPED = frozenset({'script', 'style', 'template'})
+
+	def __init__(self):
+		# we decode references ourselves to match bs4's quirks
+		super().__init__(convert_charrefs=False)
+		self.parts = []
+		# currently open elements, innermost last,
+		# as [tag, index into parts where its text starts, href, replace, unwrapped]
+		self._stack = []
+		# the text since the last tag, which bs4 would make into a single string
+		self._run = []
+		self._run_start = 0
+		self._p_depth = 0
+		self._skip_depth = 0
+
+	def _end_run(self):
+		if not self._run:
+			return
+
+		text = ''.join(self._run)
+		self._run = []
+		# bs4 squashes strings that are nothing but whitespace
+		if not text.strip(ASCII_SPACES) and not any(tag in PRESERVE_WHITESPACE for tag, *_ in self._stack):
+			self.parts[self._run_start:] = ['\n' if '\n' in text else ' ']
+
+		# extract_post_content checks `'href' in link`, which is true when one of the link's children is the string
+		# "href", not when it has a href attribute. reproduce that, since it's what decides whether links are replaced.
+		if text == 'href':
+			# mentions and hashtags get unwrapped first, so their children count as their parent's
+			parent = next((element for element in reversed(self._stack) if not element[4]), None)
+			if parent is not None and parent[0] == 'a':
+				parent[3] = True
+
+	def handle_starttag(self, tag, attrs):
+		self._end_run()
+		if tag == 'br':
+			self.parts.append('\n')
+		if tag in self.VOID:
+			return
+
+		href = None
+		unwrapped = False
+		if tag == 'a':
+			attrs = dict(attrs)
+			href = attrs.get('href')
+			# mentions and hashtags get unwrapped instead of replaced
+			unwrapped = bool({'mention', 'hashtag'} & set((attrs.get('class') or '').split()))
+		elif tag == 'p':
+			# only the outermost <p> counts, since its text already includes that of any nested ones
+			if not self._p_depth:
+				self.parts.append('\n')
+			self._p_depth += 1
+		elif tag in self.SKIPPED:
+			self._skip_depth += 1
+
+		self._stack.append([tag, len(self.parts), href, False, unwrapped])
+
+	def handle_endtag(self, tag):
+		self._end_run()
+		# like bs4, an end tag closes everything opened since its start tag, and is ignored if there isn't one
+		if not any(open_tag == tag for open_tag, *_ in self._stack):
+			return
+		while (element := self._stack.pop())[0] != tag:
+			self._close(element)
+		self._close(element)
+
+	def _close(self, element):
+		tag, start, href, replace, unwrapped = element
+		if tag == 'p':
+			self._p_depth -= 1
+			if not self._p_depth:
+				self.parts.append('\n')
+		elif tag == 'a' and replace and not unwrapped and href is not None:
+			self.parts[start:] = [href]
+		elif tag in self.SKIPPED:
+			self._skip_depth -= 1
+
+	def handle_comment(self, data):
+		self._end_run()
+
+	def handle_data(self, data):
+		if not self._skip_depth:
+			if not self._run:
+				self._run_start = len(self.parts)
+			self.parts.append(data)
+			self._run.append(data)
+
+	def handle_entityref(self, name):
+		if (char := html.unescape(f'&{name};')) == f'&{name};':
+			# bs4 passes through unknown entities, but without the semicolon
+			char = '&' + name
+		self.handle_data(char)
+
+	def handle_charref(self, name):
+		# html.unescape follows the HTML5 rules for invalid and windows-1252 numbers, same as bs4
+		self.handle_data(html.unescape(f'&#{name};'))
+
+	def close(self):
+		super().close()
+		self._end_run()
+		while self._stack:
+			self._close(self._stack.pop())
+
+def extract_post_content_fast(text):
+	parser = _PostTextParser()
+	parser.feed(text)
+	parser.close()
+	return ''.join(parser.parts).strip()
+
+def fast_path_mismatches(fixtures=FIXTURES):
+	"""return the fixtures for which the fast path disagrees with the reference implementation"""
+	from third_party.utils import extract_post_content
+	return [text for text in fixtures if extract_post_content_fast(text) != extract_post_content(text)]
+
+def extract_batch(texts, fast=False):
+	"""extract the text from every post in texts"""
+	if fast:
+		return list(map(extract_post_content_fast, texts))
+
+	from third_party.utils import extract_post_content
+	return list(map(extract_post_content, texts))
+
+def post_row(obj, content):
+	"""return the posts table row for obj, a post whose HTML has been extracted to content"""
+	return (
+		obj['id'],
+		# Pleroma returns an empty string here for posts without a CW,
+		# which is semantically incorrect IMO
+		obj['summary'] or None,
+		content,
+		pendulum.parse(obj['published']).astimezone(pendulum.timezone('UTC')).timestamp(),
+	)
+
+def compress_activity(activity):
+	return zlib.compress(json.dumps(activity, separators=(',', ':'), ensure_ascii=False).encode())
+
+def decompress_activity(data):
+	return json.loads(zlib.decompress(data))
+
+def process_activities(activities, fast=False, keep_raw=True):
+	"""turn Create activities into (posts row, compressed activity or None) pairs. meant to be run in a worker process."""
+	contents = extract_batch([activity['object']['content'] for activity in activities], fast)
+	return [
+		(post_row(activity['object'], content), compress_activity(activity) if keep_raw else None)
+		for activity, content in zip(activities, contents)
+	]
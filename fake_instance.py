@@ -0,0 +1,325 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# a stand-in for a Pleroma instance and the fediverse around it, for bench.py.
+# it serves WebFinger, actors and paginated outboxes for followed accounts spread over several "instances"
+# (different loopback addresses, so that fetch_posts.py sees them as different hosts), plus enough of the
+# Mastodon API for the bot's own account: the follow list, posting, thread context, notifications and streaming.
+# posts are made up from their index on the fly, so an account can have any number of them without using memory.
+
+import json
+import time
+import anyio
+import random
+import asyncio
+import hashlib
+from aiohttp import web
+from collections import Counter
+
+ACTIVITYPUB_CONTENT_TYPE = 'application/activity+json'
+# the account the bot is logged in as
+BOT_ID = 'bot'
+# published dates count back from here, one hour per post
+EPOCH = 1_650_000_000
+WORDS = '''
+	the of and to a in is it you that he was for on are with as i his they be at one have this from or had by hot
+	word but what some we can out other were all there when up use your how said an each she which do their time if
+	will way about many then them write would like so these her long make thing see him two has look more day could
+	go come did number sound no most people my over know water than call first who may down side been now find any
+	new work part take get place made live where after back little only round man year came show every good me give
+	our under name very through just form sentence great think say help low line differ turn cause much mean before
+	move right boy old too same tell does set three want air well also play small end put home read hand port large
+	spell add even land here must big high such follow act why ask men change went light kind off need house picture
+	try us again animal point mother world near build self earth father head stand own page should country found
+'''.split()
+
+def post_text(user, index):
+	"""the text of a user's index'th post. the same every time, and different for every post."""
+	rand = random.Random(f'{user}/{index}')
+	# skewed towards the start of the list, a bit like real word frequencies
+	words = [WORDS[int(len(WORDS) * rand.random() ** 2)] for _ in range(rand.randint(3, 30))]
+	return ' '.join(words).capitalize() + '.'
+
+class RateLimit:
+	"""a token bucket that answers like a server's rate limiter would"""
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self._tokens = burst
+		self._updated = time.monotonic()
+
+	def take(self):
+		"""return the rate limit headers to send, and whether the request is allowed"""
+		now = time.monotonic()
+		self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+		allowed = self._tokens >= 1
+		if allowed:
+			self._tokens -= 1
+		reset = (self.burst - self._tokens) / self.rate
+		return {
+			'X-RateLimit-Limit': str(self.burst),
+			'X-RateLimit-Remaining': str(int(self._tokens)),
+			'X-RateLimit-Reset': f'{reset:.3f}',
+		}, allowed
+
+class FakeInstance:
+	"""Serve made up accounts and the bot's own account over HTTP on the loopback interface.
+
+	users accounts are spread evenly over instances hosts, 127.0.0.1 through 127.0.0.{instances}, all on port.
+	127.0.0.1 is also the bot's own instance.
+	Every response is delayed by latency seconds. If rate_limit is set, each host allows that many requests per
+	second, with bursts of up to rate_burst, and answers 429 to the rest.
+	"""
+
+	def __init__(
+		self,
+		*,
+		port,
+		users=10,
+		posts_per_user=100,
+		instances=1,
+		page_size=20,
+		latency=0,
+		rate_limit=None,
+		rate_burst=300,
+	):
+		self.port = port
+		self.instances = instances
+		self.page_size = page_size
+		self.latency = latency
+		self.users = [f'user{i}@{self.host(i % instances)}' for i in range(users)]
+		# username: how many posts it has
+		self.post_counts = {user.partition('@')[0]: posts_per_user for user in self.users}
+		self._rate_limits = {
+			self.host(i): RateLimit(rate_limit, rate_burst) for i in range(instances)
+		} if rate_limit else {}
+		# (method, route name): how many requests there were, and also 'rate_limited' and 'not_modified'
+		self.requests = Counter()
+		self._sockets = set()
+		self._connected = anyio.Event()
+		self.notifications = []
+		self.statuses = []
+		# notification ID: when it was sent out
+		self.mentioned_at = {}
+		# notification ID: when the bot replied to it
+		self.replied_at = {}
+		self.replied = anyio.Event()
+		self._runner = None
+
+	def host(self, instance):
+		return f'127.0.0.{instance + 1}:{self.port}'
+
+	@property
+	def site(self):
+		return f'http://{self.host(0)}'
+
+	async def __aenter__(self):
+		app = web.Application(middlewares=[self._middleware])
+		app.add_routes([
+			web.get('/.well-known/webfinger', self._webfinger, name='webfinger'),
+			web.get('/users/{user}', self._actor, name='actor'),
+			web.get('/users/{user}/outbox', self._outbox, name='outbox'),
+			web.get('/api/v1/accounts/verify_credentials', self._verify_credentials, name='verify_credentials'),
+			web.get('/api/v1/accounts/{id}/following', self._following, name='following'),
+			web.post('/api/v1/statuses', self._post_status, name='post_status'),
+			web.get('/api/v1/statuses/{id}/context', self._context, name='context'),
+			web.put('/api/v1/pleroma/statuses/{id}/reactions/{emoji}', self._empty, name='react'),
+			web.post('/api/v1/statuses/{id}/{action:pin|unpin}', self._empty, name='pin'),
+			web.get('/api/v1/notifications', self._notifications, name='notifications'),
+			web.get('/api/v1/streaming', self._streaming, name='streaming'),
+		])
+		self._runner = web.AppRunner(app, handle_signals=False)
+		await self._runner.setup()
+		for i in range(self.instances):
+			await web.TCPSite(self._runner, f'127.0.0.{i + 1}', self.port).start()
+		return self
+
+	async def __aexit__(self, *excinfo):
+		for ws in list(self._sockets):
+			await ws.close()
+		await self._runner.cleanup()
+
+	@web.middleware
+	async def _middleware(self, request, handler):
+		route = request.match_info.route.name
+		self.requests[request.method, route] += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+
+		headers = {}
+		if (limit := self._rate_limits.get(request.host)) is not None:
+			headers, allowed = limit.take()
+			if not allowed:
+				self.requests['rate_limited'] += 1
+				return web.Response(status=429, headers={**headers, 'Retry-After': headers['X-RateLimit-Reset']})
+
+		resp = await handler(request)
+		resp.headers.update(headers)
+		return resp
+
+	def add_posts(self, n):
+		"""give every account n new posts"""
+		for user in self.post_counts:
+			self.post_counts[user] += n
+
+	# ActivityPub
+
+	def _user(self, request):
+		user = request.match_info['user']
+		if user not in self.post_counts:
+			raise web.HTTPNotFound()
+		return user
+
+	def _activity(self, base, user, index):
+		return {
+			'type': 'Create',
+			'id': f'{base}/activities/{user}/{index}',
+			'actor': f'{base}/users/{user}',
+			'object': {
+				'type': 'Note',
+				'id': f'{base}/objects/{user}/{index}',
+				'summary': None,
+				'content': f'<p>{post_text(user, index)}</p>',
+				'published': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(EPOCH + 3600 * index)),
+			},
+		}
+
+	async def _webfinger(self, request):
+		user = request.query['resource'].removeprefix('acct:').partition('@')[0]
+		if user not in self.post_counts:
+			raise web.HTTPNotFound()
+		return web.json_response({
+			'subject': request.query['resource'],
+			'links': [{'rel': 'self', 'type': ACTIVITYPUB_CONTENT_TYPE, 'href': f'http://{request.host}/users/{user}'}],
+		})
+
+	async def _actor(self, request):
+		user = self._user(request)
+		base = f'http://{request.host}'
+		return web.json_response(
+			{'type': 'Person', 'id': f'{base}/users/{user}', 'outbox': f'{base}/users/{user}/outbox'},
+			content_type=ACTIVITYPUB_CONTENT_TYPE,
+		)
+
+	async def _outbox(self, request):
+		user = self._user(request)
+		base = f'http://{request.host}'
+		outbox_url = f'{base}/users/{user}/outbox'
+		count = self.post_counts[user]
+		if 'page' not in request.query:
+			body = {
+				'type': 'OrderedCollection',
+				'id': outbox_url,
+				'totalItems': count,
+				'first': outbox_url + '?page=true',
+			}
+		else:
+			# posts are numbered from 1, oldest first. pages go newest first, and max_id keeps them stable as posts are added.
+			newest = min(count, int(request.query.get('max_id', count + 1)) - 1)
+			indices = range(newest, max(0, newest - self.page_size), -1)
+			body = {
+				'type': 'OrderedCollectionPage',
+				'partOf': outbox_url,
+				'orderedItems': [self._activity(base, user, i) for i in indices],
+			}
+			if indices and indices[-1] > 1:
+				body['next'] = f'{outbox_url}?page=true&max_id={indices[-1]}'
+
+		etag = '"' + hashlib.sha1(f'{request.path_qs} {count}'.encode()).hexdigest() + '"'
+		if request.headers.get('If-None-Match') == etag:
+			self.requests['not_modified'] += 1
+			return web.Response(status=304, headers={'ETag': etag})
+		return web.json_response(body, content_type=ACTIVITYPUB_CONTENT_TYPE, headers={'ETag': etag})
+
+	# the bot's own account
+
+	async def _verify_credentials(self, request):
+		return web.json_response({'id': BOT_ID, 'acct': BOT_ID})
+
+	async def _following(self, request):
+		limit = int(request.query.get('limit', 40))
+		offset = int(request.query.get('offset', 0))
+		page = self.users[offset:offset + limit]
+		headers = {}
+		if offset + limit < len(self.users):
+			headers['Link'] = f'<{self.site}/api/v1/accounts/{BOT_ID}/following?limit={limit}&offset={offset + limit}>; rel="next"'
+		return web.json_response(
+			[{'id': user.partition('@')[0], 'acct': user} for user in page],
+			headers=headers,
+		)
+
+	def _status(self, id, account, content, *, in_reply_to_id=None, conversation_id=None):
+		return {
+			'id': id,
+			'account': {'id': account.partition('@')[0], 'acct': account},
+			'content': content,
+			'in_reply_to_id': in_reply_to_id,
+			'mentions': [],
+			'visibility': 'public',
+			'spoiler_text': '',
+			'pleroma': {'conversation_id': conversation_id or id},
+		}
+
+	async def _post_status(self, request):
+		data = await request.json()
+		status = self._status(f'b{len(self.statuses)}', BOT_ID, data['status'], in_reply_to_id=data.get('in_reply_to_id'))
+		self.statuses.append(status)
+		if (in_reply_to_id := status['in_reply_to_id']) is not None:
+			# mentions' statuses are numbered after their notifications
+			self.replied_at.setdefault(in_reply_to_id.removeprefix('m'), time.monotonic())
+			if len(self.replied_at) >= len(self.mentioned_at):
+				self.replied.set()
+		return web.json_response(status)
+
+	async def _context(self, request):
+		return web.json_response({'ancestors': [], 'descendants': []})
+
+	async def _empty(self, request):
+		return web.json_response({})
+
+	async def _notifications(self, request):
+		notifications = self.notifications
+		limit = int(request.query.get('limit', 20))
+		# IDs count up from 1, so an ID is also how many notifications there are up to it.
+		# min_id pages forwards from the ID, otherwise it's the newest ones, the same as Mastodon.
+		if (min_id := request.query.get('min_id')) is not None:
+			notifications = notifications[int(min_id):][:limit]
+		elif (since_id := request.query.get('since_id')) is not None:
+			notifications = notifications[int(since_id):][-limit:]
+		else:
+			notifications = notifications[-limit:]
+		return web.json_response(list(reversed(notifications)))
+
+	async def _streaming(self, request):
+		ws = web.WebSocketResponse()
+		await ws.prepare(request)
+		self._sockets.add(ws)
+		self._connected.set()
+		try:
+			async for _ in ws:
+				pass
+		finally:
+			self._sockets.discard(ws)
+		return ws
+
+	async def wait_for_stream(self):
+		"""wait until something is listening to the notification stream"""
+		await self._connected.wait()
+
+	async def mention(self, text='hello'):
+		"""mention the bot from the first account, in a new thread, returning the notification ID"""
+		id = str(len(self.notifications) + 1)
+		notification = {
+			'id': id,
+			'type': 'mention',
+			'account': {'id': 'user0', 'acct': self.users[0]},
+			'status': self._status('m' + id, self.users[0], f'<p>@{BOT_ID} {text}</p>'),
+		}
+		self.notifications.append(notification)
+		self.mentioned_at[id] = time.monotonic()
+		self.replied = anyio.Event()
+		message = json.dumps({'event': 'notification', 'payload': json.dumps(notification)})
+		for ws in list(self._sockets):
+			await ws.send_str(message)
+		return id
@@ -1,32 +1,232 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import os
 import sys
+import time
 import anyio
+import anyio.to_process
+import schema
+import asyncio
+import extract
 import aiohttp
+import metrics
 import platform
 import pendulum
 import operator
 import aiosqlite
 import contextlib
 from yarl import URL
-from pleroma import Pleroma, HandleRateLimits
+from pleroma import Pleroma
 from bs4 import BeautifulSoup
 from functools import partial
+from http import HTTPStatus
+from collections import defaultdict
 from typing import Iterable, NewType
-from utils import shield, suppress, http_session_factory
-from third_party.utils import extract_post_content
+from ratelimit import RateLimiter
+from utils import http_session_factory, following
 
 UTC = pendulum.timezone('UTC')
 JSON_CONTENT_TYPE = 'application/json'
 ACTIVITYPUB_CONTENT_TYPE = 'application/activity+json'
 
-MIGRATION_VERSION = 1
+PAGES = metrics.counter('fetch_pages_total', 'Outbox pages fetched, by instance', ('instance',))
+POSTS = metrics.counter('fetch_posts_total', 'Posts written to the DB, by whether they were new', ('result',))
+FLUSH_SECONDS = metrics.histogram('db_flush_seconds', 'Time to write a batch of posts to the DB')
+EXTRACTION_SECONDS = metrics.histogram(
+	'extraction_seconds', "Time to extract a page's posts in a worker process, including waiting for a free worker",
+)
+
+def split_handle(handle):
+	"""split username@instance into (username, instance)"""
+	username, at, instance = handle.lstrip('@').partition('@')
+	assert at == '@'
+	return username, instance
+
+class InstanceProgress:
+	"""fetching progress for all the accounts on one instance"""
+	def __init__(self):
+		self.accounts_total = 0
+		self.accounts_done = 0
+		self.pages = 0
+		self.posts = 0
+		# when we started fetching from this instance, as opposed to waiting for a free slot
+		self.started_at = None
+
+	def __str__(self):
+		elapsed = time.monotonic() - self.started_at if self.started_at is not None else 0
+		rate = lambda n: n / elapsed if elapsed else 0
+		return (
+			f'{self.accounts_done}/{self.accounts_total} accounts, '
+			f'{self.pages} pages ({rate(self.pages):.1f}/s), '
+			f'{self.posts} posts ({rate(self.posts):.1f}/s)'
+		)
+
+class ActorUnavailable(Exception):
+	"""resolving an account failed recently, so we're not trying again yet"""
+
+class PipelineStats:
+	"""how well fetching pages and processing them keep up with each other, across every account"""
+	def __init__(self, depth):
+		self.depth = depth
+		self.pages = 0
+		# the sum of how many pages were waiting in the queue whenever one was taken out
+		self.queued = 0
+		# time spent by fetchers waiting for room in the queue, i.e. on processing
+		self.fetch_stalled = 0
+		# time spent by processors waiting for a page, i.e. on the network
+		self.process_stalled = 0
+
+	def __str__(self):
+		average_depth = self.queued / self.pages if self.pages else 0
+		return (
+			f'{self.pages} pages, average prefetch queue depth {average_depth:.1f}/{self.depth}, '
+			f'fetching stalled {self.fetch_stalled:.1f}s on processing, '
+			f'processing stalled {self.process_stalled:.1f}s on fetching'
+		)
+
+class BatchWriter:
+	"""Collects posts and fetch state from every account being fetched and writes them in batches.
+
+	A batch is flushed in a single transaction once it has max_rows posts in it, or every max_delay seconds,
+	whichever comes first. Fetch state is written in the same transaction as the posts it describes,
+	so a resumed fetch never skips posts that didn't make it to disk.
+	"""
+
+	def __init__(self, db, *, max_rows, max_delay):
+		self._db = db
+		self.max_rows = max_rows
+		self.max_delay = max_delay
+		self._posts = []
+		self._post_ids = set()
+		self._raw = []
+		self._states = {}
+		self._actors = {}
+		self._lock = anyio.Lock()
+		self.new = 0
+		self.duplicates = 0
+		self.flushes = 0
+		self.flush_time = 0
+
+	async def existing_post_ids(self, post_ids):
+		"""return the subset of post_ids that are already saved or waiting to be"""
+		post_ids = list(post_ids)
+		existing = self._post_ids.intersection(post_ids)
+		if post_ids:
+			async with self._db.execute(
+				f'SELECT post_id FROM posts WHERE post_id IN ({", ".join("?" * len(post_ids))})',
+				post_ids,
+			) as cur:
+				existing.update(row[0] for row in await cur.fetchall())
+		return existing
+
+	async def add_posts(self, posts, *, duplicates=0, state=None):
+		"""queue posts, an iterable of (posts table row, compressed activity or None), to be saved.
+		duplicates is how many posts the caller already skipped.
+		If state is passed, it's queued too, before this can flush, so that it's saved in the same transaction as posts.
+		"""
+		self.duplicates += duplicates
+		if state is not None:
+			self.set_state(state)
+		for row, raw in posts:
+			self._posts.append(row)
+			self._post_ids.add(row[0])
+			if raw is not None:
+				self._raw.append((row[0], raw))
+		if len(self._posts) >= self.max_rows:
+			await self.flush()
+
+	def set_state(self, state):
+		"""queue state to be saved to fetch_state along with the posts queued so far"""
+		self._states[state['account']] = dict(state, synced_at=pendulum.now(UTC).timestamp())
+
+	def set_actor(self, actor):
+		"""queue a row for the actors table to be saved with the next batch"""
+		self._actors[actor['handle']] = actor
+
+	async def flush(self):
+		async with self._lock:
+			posts, self._posts = self._posts, []
+			raw, self._raw = self._raw, []
+			self._post_ids = set()
+			states, self._states = self._states, {}
+			actors, self._actors = self._actors, {}
+			if not posts and not states and not actors:
+				return
+
+			start = time.perf_counter()
+			changes_before = self._db.total_changes
+			await self._db.executemany(
+				"""
+				INSERT INTO posts (post_id, summary, content, published_at)
+				VALUES (?, ?, ?, ?)
+				ON CONFLICT DO NOTHING
+				""",
+				posts,
+			)
+			new = self._db.total_changes - changes_before
+			await self._db.executemany(
+				'INSERT INTO raw_activities (post_id, activity) VALUES (?, ?) ON CONFLICT DO NOTHING',
+				raw,
+			)
+			for state in states.values():
+				await self._db.execute(
+					f"""
+					REPLACE INTO fetch_state ({', '.join(state)})
+					VALUES ({', '.join(':' + col for col in state)})
+					""",
+					state,
+				)
+			await self._db.executemany(
+				"""
+				REPLACE INTO actors (handle, actor_url, outbox_url, scheme, error, resolved_at)
+				VALUES (:handle, :actor_url, :outbox_url, :scheme, :error, :resolved_at)
+				""",
+				actors.values(),
+			)
+			await self._db.commit()
+
+			elapsed = time.perf_counter() - start
+			self.new += new
+			self.duplicates += len(posts) - new
+			self.flushes += 1
+			self.flush_time += elapsed
+			FLUSH_SECONDS.observe(elapsed)
+			POSTS.inc(new, result='new')
+			POSTS.inc(len(posts) - new, result='duplicate')
+
+	async def run(self):
+		"""flush periodically, until cancelled"""
+		while True:
+			await anyio.sleep(self.max_delay)
+			await self.flush()
+
+	def __str__(self):
+		return (
+			f'{self.new} new posts, {self.duplicates} duplicates, '
+			f'{self.flushes} flushes taking {self.flush_time:.2f}s'
+		)
 
 class PostFetcher:
-	def __init__(self, *, config):
+	# responses that mean an account doesn't exist (anymore)
+	GONE = frozenset({HTTPStatus.NOT_FOUND, HTTPStatus.GONE})
+
+	def __init__(self, *, config, refresh_actors=False):
+		"""if refresh_actors is true, every account is resolved again, regardless of what's cached"""
 		self.config = config
+		self._refresh_actors = refresh_actors
 		self.erroneous_accounts = []
+		# bounds how many accounts are fetched at once in total
+		self._global_limiter = anyio.CapacityLimiter(config['fetch_concurrency'])
+		# bounds how many accounts are fetched at once from each instance, so that we don't hammer any one server
+		self._instance_limiters = defaultdict(lambda: anyio.CapacityLimiter(config['fetch_concurrency_per_instance']))
+		self._progress = defaultdict(InstanceProgress)
+		self._pipeline = PipelineStats(config['fetch_prefetch_pages'])
+		# instance: the scheme its WebFinger last worked over
+		self._instance_schemes = {}
+		# HTML parsing is CPU bound, so it happens in other processes to keep it from holding up the network
+		self._extraction_limiter = anyio.CapacityLimiter(config['extraction_workers'] or os.cpu_count())
+		self._fast_extraction = config['fast_html_extraction']
 
 	async def __aenter__(self):
 		stack = contextlib.AsyncExitStack()
@@ -38,30 +238,48 @@ class PostFetcher:
 				headers={'Accept': ', '.join([JSON_CONTENT_TYPE, ACTIVITYPUB_CONTENT_TYPE])},
 				trust_env=True,
 				raise_for_status=True,
+				connection_limit=self.config['http_connection_limit'],
+				connection_limit_per_host=self.config['http_connection_limit_per_host'],
+				dns_cache_ttl=self.config['dns_cache_ttl'],
+				keepalive_timeout=self.config['http_keepalive_timeout'],
 			),
 		)
-		self._rl_handler = HandleRateLimits(self._http)
+		self._rl_handler = RateLimiter(
+			self._http,
+			rate=self.config['fetch_requests_per_second'],
+			burst=self.config['fetch_burst'],
+			max_retries=self.config['fetch_max_retries'],
+			max_backoff=self.config['fetch_max_backoff'],
+		)
+		await anyio.to_thread.run_sync(lambda: schema.connect(self.config['db_path']).close())
 		self._db = await stack.enter_async_context(aiosqlite.connect(self.config['db_path']))
-		await self._maybe_run_migrations()
-		await self._db.commit()
+		for pragma in schema.PRAGMAS:
+			await self._db.execute(pragma)
 		self._db.row_factory = aiosqlite.Row
+		self._writer = BatchWriter(
+			self._db,
+			max_rows=self.config['db_batch_size'],
+			max_delay=self.config['db_flush_interval'],
+		)
 		self._ctx_stack = stack
-		return self
-
-	async def _maybe_run_migrations(self):
-		async with self._db.cursor() as cur, suppress(aiosqlite.OperationalError):
-			if await (await cur.execute('SELECT migration_version FROM migrations')).fetchone(): return
 
-		await self._run_migrations()
+		# handle: actors table row
+		self._actors = {}
+		async with self._db.execute('SELECT * FROM actors') as cur:
+			async for row in cur:
+				self._actors[row['handle']] = dict(row)
+				if row['scheme'] is not None:
+					self._instance_schemes.setdefault(split_handle(row['handle'])[1], row['scheme'])
+
+		if self._fast_extraction and (mismatches := await anyio.to_thread.run_sync(extract.fast_path_mismatches)):
+			print(
+				'Warning: fast HTML extraction disagrees with the usual extraction for',
+				len(mismatches), 'test posts, so it is disabled. First disagreement:', repr(mismatches[0]),
+				file=sys.stderr,
+			)
+			self._fast_extraction = False
 
-	async def _run_migrations(self):
-		# TODO proper migrations, not just "has the schema ever been run" migrations
-		async with await (anyio.Path(__file__).parent/'schema.sql').open() as f:
-			schema = await f.read()
-
-		async with self._db.cursor() as cur:
-			await cur.executescript(schema)
-			await cur.execute('INSERT INTO migrations (migration_version) VALUES (?)', (MIGRATION_VERSION,))
+		return self
 
 	async def __aexit__(self, *excinfo):
 		return await self._ctx_stack.__aexit__(*excinfo)
@@ -69,16 +287,60 @@ class PostFetcher:
 	# username@instance
 	AccountHandle = NewType('AccountHandle', str)
 
-	async def fetch_all(self):
+	async def fetch_all(self, accounts: Iterable[AccountHandle] = None):
 		"""fetch all following accounts, or an iterable of accounts if provided"""
-		await self._fedi.verify_credentials()
-		self._completed_accounts = {}
+		me = await self._fedi.verify_credentials()
+		if accounts is None:
+			print('Fetching the follow list')
+			follows = following(self._rl_handler, self.config['site'], self.config['access_token'], me['id'])
+			accounts = [self.fqn(acc) async for acc in follows]
+
+		accounts = frozenset(accounts)
+		for acc in accounts:
+			self._progress[split_handle(acc)[1]].accounts_total += 1
+
+		try:
+			async with anyio.create_task_group() as tg:
+				tg.start_soon(self._report_progress)
+				tg.start_soon(self._writer.run)
+				await self._do_accounts(accounts)
+				for retry_round in range(self.config['fetch_retry_rounds']):
+					if not (failed := self.erroneous_accounts):
+						break
+					self.erroneous_accounts = []
+					# let whatever went wrong blow over first.
+					# also, the failed accounts' progress has to be saved, since it's what a retry resumes from.
+					await anyio.sleep(self._rl_handler.max_backoff)
+					await self._writer.flush()
+					print(f'Retrying {len(failed)} accounts that failed')
+					for acc in failed:
+						self._progress[split_handle(acc)[1]].accounts_done -= 1
+					await self._do_accounts(failed)
+				tg.cancel_scope.cancel()
+		finally:
+			with anyio.CancelScope(shield=True):
+				await self._writer.flush()
+
+		self._print_progress()
+		print('Saved', self._writer)
+		print('Pipeline:', self._pipeline)
+		if self._rl_handler.retries:
+			print('Retried', self._rl_handler.retries, 'requests')
+
+	async def _do_accounts(self, accounts):
 		async with anyio.create_task_group() as tg:
-			# for fqn in map(self.fqn, await self._fedi.following()):
-			#tg.start_soon(self._do_account, 'theresnotime@tech.lgbt')
-			tg.start_soon(self._do_account, 'theresnotime@labyrinth.zone')
-			tg.start_soon(self._do_account, 'theresnotime@wikis.world')
-			tg.start_soon(self._do_account, 'theresnotime@fox.nexus')
+			for acc in accounts:
+				tg.start_soon(self._do_account, acc)
+
+	async def _report_progress(self):
+		while True:
+			await anyio.sleep(self.config['fetch_progress_interval'])
+			self._print_progress()
+
+	def _print_progress(self):
+		for instance, progress in sorted(self._progress.items()):
+			if progress.started_at is not None:
+				print(f'{instance}: {progress}')
 
 	def fqn(self, acc: dict):
 		try:
@@ -89,107 +351,331 @@ class PostFetcher:
 			return fqn + '@' + URL(self.config['site']).host
 
 	async def _do_account(self, acc: AccountHandle):
-		async with anyio.create_task_group() as tg:
-			self._completed_accounts[acc] = done_ev = anyio.Event()
-			tx, rx = anyio.create_memory_object_stream()
-			async with rx, tx:
-				tg.start_soon(self._process_pages, rx, acc)
-				tg.start_soon(self._fetch_account, tx, acc)
-				await done_ev.wait()
-			# processing is complete, so halt fetching.
-			# processing may complete before fetching if we get caught up on new posts.
-			tg.cancel_scope.cancel()
-
-	async def _process_pages(self, stream, account):
-		done_ev = self._completed_accounts[account]
+		instance = split_handle(acc)[1]
+		progress = self._progress[instance]
+		# take the instance slot first so that we don't sit on a global slot while waiting on a busy instance
+		async with self._instance_limiters[instance], self._global_limiter:
+			if progress.started_at is None:
+				progress.started_at = time.monotonic()
+			await self._do_account_inner(acc)
+		progress.accounts_done += 1
+
+	async def _do_account_inner(self, acc: AccountHandle):
+		state = await self._load_fetch_state(acc)
 		try:
-			async for activity in stream:
-				try:
-					await self._insert_activity(activity)
-				except aiosqlite.IntegrityError as exc:
-					# LOL sqlite error handling is so bad
-					if exc.args[0].startswith('UNIQUE constraint failed: '):
-						# this means we've encountered an item we already have saved
-						# TODO we need to ignore this if we don't actually have all the posts.
-						# For example, if a prior fetch was interrupted, we'll have k pages of the most recent posts,
-						# but no more. But since we still have the most recent page saved, it'll *look* like
-						# we've saved everything, since we stop as soon as we encounter a post we already have.
-						# To fix this we can check against totalItems in the user's outbox.
-						break
-
-					self.erroneous_accounts.append(account)
-					raise
-		finally:
-			print('Saving posts from', account, 'to the DB')
-			await self._db.commit()
-			done_ev.set()
-
-	async def _insert_activity(self, activity):
-		if activity['type'] != 'Create':
-			# this isn't a post but something else (like, boost, reaction, etc)
-			return
-
-		obj = activity['object']
-
-		await self._db.execute(
-			"""
-			INSERT INTO posts (post_id, summary, content, published_at)
-			VALUES (?, ?, ?, ?)
-			""",
-			(
-				obj['id'],
-				# Pleroma returns an empty string here for posts without a CW,
-				# which is semantically incorrect IMO
-				obj['summary'] or None,
-				extract_post_content(obj['content']),
-				pendulum.parse(obj['published']).astimezone(pendulum.timezone('UTC')).timestamp(),
-			),
-		)
-
-	# TODO figure out why i put shield here lol
-	@shield
-	async def _fetch_account(self, tx, account: AccountHandle):
-		done_ev = self._completed_accounts[account]
-
-		try:
-			outbox = await self.fetch_outbox(account)
+			await self._sync_account(acc, state)
+		except ActorUnavailable as exc:
+			# this was already reported when it failed
+			print(exc)
 		except Exception as exc:
+			# whatever we managed to save is recorded in state, so the next run will resume from there
 			import traceback
 			traceback.print_exception(type(exc), exc, exc.__traceback__)
-			done_ev.set()
-			self.erroneous_accounts.append(account)
-			return
+			self.erroneous_accounts.append(acc)
+		finally:
+			# saved with the next batch of posts
+			print('Done with', acc)
+			self._writer.set_state(state)
+
+	async def _sync_account(self, account: AccountHandle, state):
+		outbox_url = await self.outbox_url(account)
+		# validators for the responses we got. these only get saved once we're done with what the responses said,
+		# otherwise an interrupted sync would look up to date next time.
+		validators = {}
+		try:
+			outbox = await self._conditional_get(outbox_url, state, 'outbox', validators)
+		except aiohttp.ClientResponseError as exc:
+			if exc.status not in self.GONE: raise
+			# the cached outbox URL might be out of date, e.g. if the account moved to a different URL on the same
+			# instance. look it up again, and only give up if we get the same URL.
+			if (new_url := await self.outbox_url(account, refresh=True)) == outbox_url: raise
+			outbox_url = new_url
+			outbox = await self._conditional_get(outbox_url, state, 'outbox', validators)
+		state['outbox_url'] = outbox_url
+		was_complete = state['backfill_complete']
+
+		if outbox is None:
+			if was_complete and state['head_cursor'] is None:
+				print(f'{account} is unchanged')
+				return
+			# the outbox hasn't changed, but there's still backfilling or an interrupted fetch of new posts left to do
+			first_page_url = state['first_page_url']
+		else:
+			assert outbox['type'] == 'OrderedCollection'
+			state['total_items'] = outbox.get('totalItems')
+			first_page_url = outbox['first']
+			# saved now, since a later sync that gets a 304 for the outbox still needs it to resume backfilling from
+			if first_page_url != state['first_page_url']:
+				# the validators we have are for some other URL
+				state.update(first_page_url=first_page_url, first_page_etag=None, first_page_last_modified=None)
 
 		print(f'Fetching posts for {account}...')
 
-		next_page_url = outbox['first']
-		while True:
-			print(f'Fetching {next_page_url}... ')
-			async with self._rl_handler.request('GET', next_page_url) as resp: page = await resp.json()
+		if state['newest_id'] is None:
+			# we've never synced this account before, so the head is also where the backfill starts
+			state['tail_cursor'] = first_page_url
+		else:
+			if state['head_cursor'] is not None:
+				# the last fetch of new posts was interrupted. finish it before looking for anything newer.
+				await self._walk(account, state, state['head_cursor'], head=True)
+			if outbox is not None:
+				# only fetch what's new since last time
+				await self._walk(account, state, first_page_url, head=True, validators=validators)
+
+		walked_everything = not state['backfill_complete']
+		if not state['backfill_complete']:
+			# pick up where a previous, interrupted, fetch left off
+			await self._walk(account, state, state['tail_cursor'], head=False)
+		elif was_complete and self._has_gap(state):
+			# we went through the whole outbox at some point but now we're coming up short,
+			# which means that something got skipped. go through the whole thing again to fill the gap.
+			print(f'Found a gap in {account} ({state["items_seen"]}/{state["total_items"]} items), refetching')
+			state.update(items_seen=0, tail_cursor=first_page_url, backfill_complete=0)
+			walked_everything = True
+			await self._walk(account, state, state['tail_cursor'], head=False)
+
+		if walked_everything and state['backfill_complete']:
+			state['hidden_items'] = max(0, (state['total_items'] or 0) - state['items_seen'])
+
+		state.update(validators)
+
+	async def _conditional_get(self, url, state, prefix, validators):
+		"""GET url, returning None if it hasn't changed since the last time we fetched it.
+
+		The validators from the last fetch are taken from the {prefix}_etag and {prefix}_last_modified keys of state,
+		and the new ones are stored in validators under the same keys.
+		"""
+		headers = {}
+		if state.get(f'{prefix}_url') == url:
+			if etag := state[f'{prefix}_etag']:
+				headers['If-None-Match'] = etag
+			if last_modified := state[f'{prefix}_last_modified']:
+				headers['If-Modified-Since'] = last_modified
+
+		async with self._rl_handler.request('GET', url, headers=headers) as resp:
+			if resp.status == HTTPStatus.NOT_MODIFIED:
+				return None
+			body = await resp.json()
+
+		validators.update({
+			f'{prefix}_url': url,
+			f'{prefix}_etag': resp.headers.get('ETag'),
+			f'{prefix}_last_modified': resp.headers.get('Last-Modified'),
+		})
+		return body
+
+	@staticmethod
+	def _has_gap(state):
+		if state['total_items'] is None:
+			return False
+		return state['total_items'] - state['items_seen'] > state['hidden_items']
+
+	async def _load_fetch_state(self, account):
+		async with self._db.execute('SELECT * FROM fetch_state WHERE account = ?', (account,)) as cur:
+			if (row := await cur.fetchone()) is not None:
+				return dict(row)
+
+		return dict(
+			account=account,
+			outbox_url=None,
+			total_items=None,
+			items_seen=0,
+			hidden_items=0,
+			outbox_etag=None,
+			outbox_last_modified=None,
+			first_page_url=None,
+			first_page_etag=None,
+			first_page_last_modified=None,
+			newest_id=None,
+			oldest_id=None,
+			tail_cursor=None,
+			head_cursor=None,
+			head_newest_id=None,
+			backfill_complete=0,
+			synced_at=None,
+		)
+
+	async def _walk(self, account, state, url, *, head, validators=None):
+		"""fetch pages starting at url until we reach the end of the outbox or,
+		if head is true, until we reach the newest post from the previous sync.
+
+		If validators is passed, the first page is only fetched if it changed since last time,
+		and its new validators are stored in validators.
+		"""
+		async with anyio.create_task_group() as tg:
+			# buffered, so that the next pages are already being fetched while this one is processed
+			tx, rx = anyio.create_memory_object_stream(self._pipeline.depth)
+			# the page with the newest item from last time is the last new one, so don't prefetch past it
+			stop_at = state['newest_id'] if head else None
+			tg.start_soon(self._fetch_pages, tx, account, state, url, validators, stop_at)
+			await self._process_pages(rx, account, state, head=head)
+			# processing is complete, so halt fetching.
+			# processing may complete before fetching if we get caught up on new posts.
+			tg.cancel_scope.cancel()
 
-			for activity in page['orderedItems']:
+	async def _process_pages(self, stream, account, state, *, head):
+		progress = self._progress[split_handle(account)[1]]
+		last_newest_id = state['newest_id']
+		# when fetching new posts, newest_id only moves once we've caught up to it. until then, where we are is kept
+		# in head_cursor, so that an interrupted fetch is finished next time, instead of leaving a gap.
+		first_page = True
+		# the page an interrupted fetch of new posts resumes from may have posts on it that we got some other way,
+		# e.g. by backfilling, so on that page, those don't mean we've caught up
+		resuming = head and state['head_newest_id'] is not None
+		caught_up = False
+		async with stream:
+			while True:
+				waiting_since = time.monotonic()
+				try:
+					page = await stream.receive()
+				except anyio.EndOfStream:
+					break
+				self._pipeline.process_stalled += time.monotonic() - waiting_since
+				self._pipeline.pages += 1
+				self._pipeline.queued += stream.statistics().current_buffer_used
+
+				items = page['orderedItems']
+				if first_page and items:
+					if head:
+						# unless we're resuming, in which case it's from when we started
+						if state['head_newest_id'] is None:
+							state['head_newest_id'] = items[0]['id']
+					elif state['newest_id'] is None:
+						state['newest_id'] = items[0]['id']
+				first_page = False
+
+				if head and last_newest_id in (ids := [activity['id'] for activity in items]):
+					items = items[:ids.index(last_newest_id)]
+					caught_up = True
+
+				# anything else isn't a post but something else (like, boost, reaction, etc)
+				posts = {i: activity for i, activity in enumerate(items) if activity['type'] == 'Create'}
+				existing = await self._writer.existing_post_ids(activity['object']['id'] for activity in posts.values())
+				if head and existing and not resuming:
+					# we've encountered a post we already have saved, which means we've caught up,
+					# and the newest item from last time has since been deleted.
+					# (when backfilling after an interrupted fetch, that's expected, and not a reason to stop.)
+					cutoff = next(i for i, activity in posts.items() if activity['object']['id'] in existing)
+					items = items[:cutoff]
+					posts = {i: activity for i, activity in posts.items() if i < cutoff}
+					caught_up = True
+
+				resuming = False
+				new_posts = [activity for activity in posts.values() if activity['object']['id'] not in existing]
+				rows = await self._process(new_posts)
+				progress.posts += len(new_posts)
+				state['items_seen'] += len(items)
+				reached_end = not caught_up and not page.get('next')
+
+				# move our place past this page before its posts are queued, since queueing them may flush them
+				if head:
+					if caught_up or reached_end:
+						if state['head_newest_id'] is not None:
+							state['newest_id'] = state['head_newest_id']
+						state.update(head_cursor=None, head_newest_id=None)
+					else:
+						state['head_cursor'] = page['next']
+				else:
+					state['tail_cursor'] = page.get('next')
+					if items: state['oldest_id'] = items[-1]['id']
+					if reached_end: state['backfill_complete'] = 1
+
+				# saved in the same transaction as the posts, so that an interrupted fetch resumes from right after them
+				await self._writer.add_posts(rows, duplicates=len(posts) - len(new_posts), state=state)
+
+				if caught_up or reached_end:
+					break
+
+	async def _process(self, activities):
+		"""turn a batch of Create activities into (posts row, raw activity) pairs"""
+		if not activities:
+			return []
+
+		with EXTRACTION_SECONDS.time():
+			return await anyio.to_process.run_sync(
+				extract.process_activities,
+				activities,
+				self._fast_extraction,
+				self.config['store_raw_activities'],
+				limiter=self._extraction_limiter,
+			)
+
+	async def _fetch_pages(self, tx, account: AccountHandle, state, next_page_url, validators=None, stop_at=None):
+		async with tx:
+			while next_page_url:
+				print(f'Fetching {next_page_url}... ')
+				if validators is not None:
+					if (page := await self._conditional_get(next_page_url, state, 'first_page', validators)) is None:
+						# nothing new
+						return
+					validators = None
+				else:
+					async with self._rl_handler.request('GET', next_page_url) as resp: page = await resp.json()
+				instance = split_handle(account)[1]
+				self._progress[instance].pages += 1
+				PAGES.inc(instance=instance)
+
+				waiting_since = time.monotonic()
 				try:
-					await tx.send(activity)
+					await tx.send(page)
 				except anyio.BrokenResourceError:
 					# already closed means we're already done
 					return
+				finally:
+					self._pipeline.fetch_stalled += time.monotonic() - waiting_since
 
-			# show progress
-			#print('.', end='', flush=True)
+				if stop_at is not None and any(item['id'] == stop_at for item in page['orderedItems']):
+					return
+				next_page_url = page.get('next')
 
-			if not (next_page_url := page.get('next')):
-				#done_ev.set()
-				break
+	async def outbox_url(self, handle, *, refresh=False):
+		"""return the outbox URL of handle, a fully-qualified ActivityPub actor name.
 
-		done_ev.set()
+		Accounts are only resolved again once their actors table entry expires, or if refresh is true.
+		Raises ActorUnavailable if resolving handle failed recently.
+		"""
+		if not refresh and (actor := self._cached_actor(handle)) is not None:
+			if actor['error'] is not None:
+				raise ActorUnavailable(f'Skipping {handle}, since resolving it failed recently: {actor["error"]}')
+			return actor['outbox_url']
 
-	async def fetch_outbox(self, handle):
-		"""finger handle, a fully-qualified ActivityPub actor name, returning their outbox URL"""
+		actor = dict(handle=handle, actor_url=None, outbox_url=None, scheme=None, error=None)
+		try:
+			actor['actor_url'], actor['outbox_url'] = await self._resolve_actor(handle)
+		except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+			# the instance is down, or gone entirely
+			actor['error'] = f'{type(exc).__name__}: {exc}'
+			raise
+		except aiohttp.ClientResponseError as exc:
+			if exc.status in self.GONE:
+				actor['error'] = f'{exc.status} {exc.message}'
+			raise
+		finally:
+			# rate limits and server errors are usually temporary, so don't cache those
+			if actor['outbox_url'] is not None or actor['error'] is not None:
+				actor.update(scheme=self._instance_schemes.get(split_handle(handle)[1]), resolved_at=time.time())
+				self._writer.set_actor(actor)
+				# failures only take effect from the next run, so that retries in this one still get a chance
+				if actor['error'] is None:
+					self._actors[handle] = actor
+
+		return actor['outbox_url']
+
+	def _cached_actor(self, handle):
+		"""return the actors table row for handle, or None if it isn't cached or has expired"""
+		if self._refresh_actors or (actor := self._actors.get(handle)) is None:
+			return None
+		ttl = self.config['actor_cache_ttl'] if actor['error'] is None else self.config['actor_negative_cache_ttl']
+		if time.time() - actor['resolved_at'] >= ttl:
+			return None
+		return actor
+
+	async def _resolve_actor(self, handle):
+		"""finger handle, returning its actor URL and outbox URL"""
 		# it's fucking incredible how overengineered ActivityPub is btw
 		print('Fingering ', handle, '...', sep='')
 
-		username, at, instance = handle.lstrip('@').partition('@')
-		assert at == '@'
+		username, instance = split_handle(handle)
 
 		# i was planning on doing /.well-known/host-meta to find the webfinger URL, but
 		# 1) honk does not support host-meta
@@ -197,28 +683,45 @@ class PostFetcher:
 
 		profile_url = await self._finger_actor(username, instance)
 		print(profile_url)
-		"""
 		try:
-			async with self._http.get(profile_url) as resp: profile = await resp.json()
-		except aiohttp.ContentTypeError:
-			# we didn't get JSON, so just guess the outbox URL
-			outbox_url = profile_url + '/outbox'
-		else:
+			async with self._rl_handler.request('GET', profile_url) as resp: profile = await resp.json()
 			outbox_url = profile['outbox']
-		"""
-		outbox_url = profile_url + '/outbox'
+		except (aiohttp.ContentTypeError, aiohttp.ClientResponseError, KeyError, TypeError):
+			# we didn't get an actor (e.g. the instance requires signed fetches), so just guess the outbox URL
+			outbox_url = profile_url + '/outbox'
 		print(outbox_url)
-		async with self._http.get(outbox_url) as resp:
-			outbox = await resp.json()
-			assert outbox['type'] == 'OrderedCollection'
-			return outbox
+		return profile_url, outbox_url
 
-	async def _finger_actor(self, username, instance):
+	def _schemes(self, instance):
+		"""return the schemes to try WebFinger over for instance, most likely to work first"""
 		# despite HTTP being a direct violation of the WebFinger spec, assume e.g. Tor instances do not support
 		# HTTPS-over-onion
-		finger_url = f'http://{instance}/.well-known/webfinger?resource=acct:{username}@{instance}'
-		async with self._http.get(finger_url) as resp: finger_result = await resp.json()
-		return (profile_url := self._parse_webfinger_result(username, instance, finger_result))
+		if URL(f'//{instance}').host.endswith(('.onion', '.i2p')):
+			schemes = ['http', 'https']
+		else:
+			# HTTPS first, since most instances would just redirect us there anyway
+			schemes = ['https', 'http']
+
+		if (learned := self._instance_schemes.get(instance)) is not None:
+			schemes.remove(learned)
+			schemes.insert(0, learned)
+		return schemes
+
+	async def _finger_actor(self, username, instance):
+		schemes = self._schemes(instance)
+		for scheme in schemes:
+			finger_url = f'{scheme}://{instance}/.well-known/webfinger?resource=acct:{username}@{instance}'
+			try:
+				# if this isn't the last scheme to try, trying the next one is a better use of time than retrying
+				async with self._rl_handler.request(
+					'GET', finger_url, retries=None if scheme == schemes[-1] else 0,
+				) as resp:
+					finger_result = await resp.json()
+			except aiohttp.ClientError:
+				if scheme == schemes[-1]: raise
+				continue
+			self._instance_schemes[instance] = scheme
+			return (profile_url := self._parse_webfinger_result(username, instance, finger_result))
 
 	def _parse_webfinger_result(self, username, instance, finger_result):
 		"""given webfinger data, return profile URL for handle"""
@@ -244,9 +747,25 @@ class PostFetcher:
 async def amain():
 	import json5 as json
 	import third_party.utils as utils
-	args = utils.arg_parser_factory(description='Fetch posts from all followed accounts').parse_args()
+	parser = utils.arg_parser_factory(description='Fetch posts from all followed accounts')
+	parser.add_argument(
+		'accounts', nargs='*', metavar='username@instance',
+		help='Only fetch these accounts, instead of every account the bot follows.',
+	)
+	parser.add_argument(
+		'--refresh-actors', action='store_true',
+		help='Look up every account again, even if it was looked up recently.',
+	)
+	args = parser.parse_args()
 	config = utils.load_config(args.cfg)
-	async with PostFetcher(config=config) as fetcher: await fetcher.fetch_all()
+	async with metrics.reporting(config):
+		async with PostFetcher(config=config, refresh_actors=args.refresh_actors) as fetcher:
+			await fetcher.fetch_all(args.accounts or None)
+		if config['generation_mode'] is utils.TextGenerationMode.markov:
+			# fold the new posts into the cached model so that generation never has to build it
+			from generators import markov
+			print('Updating the markov model')
+			await anyio.to_thread.run_sync(markov.update_model, config)
 	if (accs := fetcher.erroneous_accounts):
 		print(
 			'Exiting unsuccessfully due to previous errors in these accounts:',
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import gc
 import re
+import anyio
+import metrics
 from third_party import utils
-from pleroma import Pleroma
+from generators import buffer
 
 def parse_args():
 	parser = utils.arg_parser_factory(description='Generate and post a toot.')
@@ -16,6 +19,17 @@ def parse_args():
 		default='markov',
 		help='Pass one of these: ' + ', '.join(utils.TextGenerationMode.__members__),
 	)
+	parser.add_argument(
+		'-b', '--batch', dest='batch', type=int, metavar='N',
+		help='Generate N posts using every CPU and save them for later runs to post, instead of posting.',
+	)
+	parser.add_argument(
+		'-r', '--refill', dest='refill', action='store_true',
+		help=(
+			'Top the post buffer up to post_buffer_size if it has dropped below post_buffer_low_water, instead of posting. '
+			'Run this as its own cron job, so that posting never waits for it.'
+		),
+	)
 	return parser.parse_args()
 
 PAIRED_PUNCTUATION = re.compile(r"[{}]".format(re.escape('[](){}"‘’“”«»„')))
@@ -23,14 +37,34 @@ PAIRED_PUNCTUATION = re.compile(r"[{}]".format(re.escape('[](){}"‘’“”«
 async def main():
 	args = parse_args()
 	cfg = utils.load_config(args.cfg)
+	mode = utils.TextGenerationMode.__members__[args.mode]
+
+	async with metrics.reporting(cfg):
+		if args.batch is not None:
+			print('Generated', await buffer.fill(cfg, mode, args.batch), 'posts')
+			return
+		if args.refill:
+			print('Generated', await buffer.refill(cfg, mode), 'posts')
+			return
+
+		# this process is gone a second from now, so the cyclic garbage collector would only be going over the model
+		# for nothing, both while it runs and once more on exit, unless everything's frozen first.
+		# (long-running processes that load models, like the reply service's workers, mustn't do this.)
+		gc.disable()
+		try:
+			await post(args, cfg, await utils.make_post(cfg, mode=mode))
+		finally:
+			gc.freeze()
 
-	toot = await utils.make_post(cfg, mode=utils.TextGenerationMode.__members__[args.mode])
+async def post(args, cfg, toot):
 	if cfg['strip_paired_punctuation']:
 		toot = PAIRED_PUNCTUATION.sub("", toot)
 	toot = toot.replace("@", "@\u200b")  # sanitize mentions
 	toot = utils.remove_mentions(cfg, toot)
 
 	if not args.simulate:
+		# aiohttp, which pleroma.py uses, takes longer to import than everything else gen.py needs put together
+		from pleroma import Pleroma
 		async with Pleroma(api_base_url=cfg['site'], access_token=cfg['access_token']) as pl:
 			try:
 				await pl.post(toot, visibility='unlisted', cw=cfg['cw'])
@@ -50,5 +84,4 @@ async def main():
 		print(toot.encode("ascii", "ignore"))  # encode as ASCII, dropping any non-ASCII characters
 
 if __name__ == '__main__':
-	import anyio
 	anyio.run(main)
@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# a buffer of sentences generated ahead of time, stored in the generated_posts table.
+# posting pops a sentence from here, which is much cheaper than generating one.
+
+import os
+import time
+import anyio
+import schema
+
+# how many sentences each worker generates per job. small enough that progress gets saved often,
+# big enough that the per-job overhead doesn't matter.
+CHUNK_SIZE = 50
+
+# (db_path, mode name) of buffers that were empty with post_buffer_size at 0, so that nothing in this process refills them
+_known_empty = set()
+
+OLDEST = 'SELECT id, content FROM generated_posts WHERE generation_mode = ? ORDER BY id LIMIT 1'
+
+def pop(cfg, mode):
+	"""remove and return the oldest buffered sentence for mode, or None if there aren't any"""
+	if (key := (cfg['db_path'], mode.name)) in _known_empty:
+		return None
+
+	db = schema.connect(cfg['db_path'])
+	# transactions are handled below
+	db.isolation_level = None
+	try:
+		# looked for without locking anything first, since with the buffer empty, that's all there is to do
+		if db.execute(OLDEST, (mode.name,)).fetchone() is None:
+			if not cfg['post_buffer_size']:
+				# nothing's going to fill it (short of gen.py --batch), so don't even look again
+				_known_empty.add(key)
+			return None
+
+		# taking the write lock before reading, so that two processes can't both pop the same sentence
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			if (row := db.execute(OLDEST, (mode.name,)).fetchone()) is not None:
+				db.execute('DELETE FROM generated_posts WHERE id = ?', (row[0],))
+		except BaseException:
+			db.execute('ROLLBACK')
+			raise
+		db.execute('COMMIT')
+	finally:
+		db.close()
+
+	return row and row[1]
+
+def count(cfg, mode):
+	db = schema.connect(cfg['db_path'])
+	try:
+		return db.execute('SELECT count(*) FROM generated_posts WHERE generation_mode = ?', (mode.name,)).fetchone()[0]
+	finally:
+		db.close()
+
+def store(cfg, mode, sentences):
+	db = schema.connect(cfg['db_path'])
+	try:
+		with db:
+			now = time.time()
+			db.executemany(
+				'INSERT INTO generated_posts (content, generation_mode, generated_at) VALUES (?, ?, ?)',
+				((sentence, mode.name, now) for sentence in sentences),
+			)
+	finally:
+		db.close()
+
+async def fill(cfg, mode, n, *, pool=None):
+	"""generate n sentences on every core and add them to the buffer. returns how many were actually generated."""
+	if pool is None:
+		# only imported here, since popping a sentence is on gen.py's startup path, and filling isn't
+		from generators.pool import GeneratorPool
+		async with GeneratorPool(cfg, mode=mode, workers=os.cpu_count()) as pool:
+			return await fill(cfg, mode, n, pool=pool)
+
+	generated = 0
+
+	async def do_chunk(size):
+		nonlocal generated
+		sentences = await pool.make_sentences(size)
+		await anyio.to_thread.run_sync(store, cfg, mode, sentences)
+		generated += len(sentences)
+
+	async with anyio.create_task_group() as tg:
+		for start in range(0, n, CHUNK_SIZE):
+			tg.start_soon(do_chunk, min(CHUNK_SIZE, n - start))
+
+	if n and not generated:
+		raise ValueError('Failed to generate any sentences!')
+
+	return generated
+
+async def refill(cfg, mode, *, pool=None):
+	"""top up the buffer to post_buffer_size if it has dropped below post_buffer_low_water"""
+	if not (target := cfg['post_buffer_size']):
+		return 0
+
+	have = await anyio.to_thread.run_sync(count, cfg, mode)
+	# post_buffer_low_water may well be set higher than post_buffer_size
+	if have >= cfg['post_buffer_low_water'] or have >= target:
+		return 0
+
+	return await fill(cfg, mode, target - have, pool=pool)
@@ -0,0 +1,248 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# a markov chain stored as flat arrays of integers instead of dicts of tuples of strings, for the markov_backend
+# "compact" setting. every word is interned to an integer ID, and the chain is kept as sorted state keys, each with
+# a slice of next word IDs and cumulative weights to bisect. the arrays are saved to a single file that gets mmapped,
+# so every process using the same model shares one copy of it through the page cache.
+
+import json
+import mmap
+import random
+import numpy as np
+from bisect import bisect_left, bisect_right
+
+MAGIC = b'PEBCHAIN'
+FORMAT_VERSION = 1
+# arrays in the model file start at multiples of this, so that they can be used straight from the mmap
+ALIGNMENT = 64
+BEGIN_ID = 0
+END_ID = 1
+# the original text is indexed by hashes of this many words, for overlap checks
+ANCHOR_SIZE = 3
+# for hashing anchors. odd 64-bit constants, so that multiplying by them mod 2**64 loses nothing.
+ANCHOR_MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9)
+MASK64 = 2 ** 64 - 1
+
+def _radix(state_size):
+	"""what state keys are written in: a state's key is its word IDs as digits in this base"""
+	return 2 ** (63 // state_size)
+
+def _anchor_hash(ids):
+	h = 0
+	for i, multiplier in zip(ids, ANCHOR_MULTIPLIERS):
+		h ^= i * multiplier & MASK64
+	return h
+
+class CompactModel:
+	"""a markov chain built by build() or loaded by load()"""
+
+	def __init__(self, arrays, *, state_size, meta=None, mm=None):
+		self.arrays = arrays
+		self.state_size = state_size
+		self.meta = meta or {}
+		# keep the mmap open for as long as the arrays in it are being used
+		self._mm = mm
+		self._radix = _radix(state_size)
+		self.begin_state = (BEGIN_ID,) * state_size
+		self.end = END_ID
+
+		# bisect and indexing are much cheaper on memoryviews than on numpy arrays, at least one element at a time
+		self._state_keys = memoryview(arrays['state_keys'])
+		self._transition_offsets = memoryview(arrays['transition_offsets'])
+		self._next_ids = memoryview(arrays['next_ids'])
+		self._cumulative_weights = memoryview(arrays['cumulative_weights'])
+		self._word_offsets = memoryview(arrays['word_offsets'])
+		self._word_lengths = memoryview(arrays['word_lengths'])
+		self._word_bytes = memoryview(arrays['word_bytes'])
+		self.overlap_index = OverlapIndex(arrays)
+
+	def __len__(self):
+		"""how many words the model knows"""
+		return len(self._word_lengths)
+
+	def move(self, state):
+		"""given a tuple of word IDs, choose the next word ID at random"""
+		key = 0
+		for i in state:
+			key = key * self._radix + i
+		state_index = bisect_left(self._state_keys, key)
+		lo, hi = self._transition_offsets[state_index], self._transition_offsets[state_index + 1]
+		r = random.random() * self._cumulative_weights[hi - 1]
+		return self._next_ids[bisect_right(self._cumulative_weights, r, lo, hi)]
+
+	def word(self, i):
+		return bytes(self._word_bytes[self._word_offsets[i]:self._word_offsets[i + 1]]).decode()
+
+	def word_length(self, i):
+		return self._word_lengths[i]
+
+	def words(self):
+		return [self.word(i) for i in range(len(self))]
+
+	def join(self, ids):
+		return ' '.join(map(self.word, ids))
+
+class OverlapIndex:
+	"""Answers whether a sequence of word IDs appears in the text a model was learned from.
+
+	Every position in the text is indexed by a hash of the words that start there, sorted,
+	so a lookup is a binary search followed by comparing the few places that start the same way.
+	"""
+
+	def __init__(self, arrays):
+		self._tokens = memoryview(arrays['tokens'])
+		self._anchor_keys = memoryview(arrays['anchor_keys'])
+		self._anchor_positions = memoryview(arrays['anchor_positions'])
+
+	def __contains__(self, ids):
+		if len(ids) < ANCHOR_SIZE:
+			# every word and every pair of words a walk comes up with came from the text
+			return True
+
+		key = _anchor_hash(ids[:ANCHOR_SIZE])
+		lo = bisect_left(self._anchor_keys, key)
+		hi = bisect_right(self._anchor_keys, key, lo)
+		return any(
+			self._tokens[position:position + len(ids)].tolist() == ids
+			for position in self._anchor_positions[lo:hi]
+		)
+
+def build(runs, *, state_size=2, base=None):
+	"""Build a model from runs, lists of words (e.g. markovify's parsed sentences).
+
+	If base is passed, the new model is learned from everything base was learned from as well.
+	"""
+	radix = _radix(state_size)
+	if base is None:
+		words = [None, None]
+		ids = {}
+		# the text, as word IDs, with every run padded like a walk sees it: state_size BEGINs, then the words, then END
+		tokens = np.empty(0, dtype=np.int32)
+	else:
+		if base.state_size != state_size:
+			raise ValueError(f'Can not extend a model with state size {base.state_size} to state size {state_size}')
+		words = base.words()
+		ids = {word: i for i, word in enumerate(words) if i not in (BEGIN_ID, END_ID)}
+		tokens = np.asarray(base.arrays['tokens'])
+
+	new_tokens = []
+	padding = [BEGIN_ID] * state_size
+	for run in runs:
+		new_tokens.extend(padding)
+		for word in run:
+			if (i := ids.get(word)) is None:
+				i = ids[word] = len(words)
+				words.append(word)
+			new_tokens.append(i)
+		new_tokens.append(END_ID)
+
+	if len(words) > radix:
+		raise ValueError(f'Too many different words ({len(words)}) for state size {state_size}')
+
+	tokens = np.concatenate((tokens, np.array(new_tokens, dtype=np.int32)))
+	if not (tokens > END_ID).any():
+		raise ValueError('Nothing to learn from')
+	t = tokens.astype(np.int64)
+
+	# every transition in the text: the state_size words at each position, and the word after them.
+	# transitions out of an END or into the next run's padding aren't real.
+	n = len(t) - state_size
+	keys = np.zeros(n, dtype=np.int64)
+	valid = t[state_size:] != BEGIN_ID
+	for j in range(state_size):
+		keys = keys * radix + t[j:j + n]
+		valid &= t[j:j + n] != END_ID
+	keys, next_ids = keys[valid], t[state_size:][valid]
+
+	# count identical transitions, then group them by state
+	order = np.lexsort((next_ids, keys))
+	keys, next_ids = keys[order], next_ids[order]
+	pair_starts = np.flatnonzero(np.concatenate(([True], (keys[1:] != keys[:-1]) | (next_ids[1:] != next_ids[:-1]))))
+	counts = np.diff(np.append(pair_starts, len(keys)))
+	pair_keys, pair_next_ids = keys[pair_starts], next_ids[pair_starts]
+	state_starts = np.flatnonzero(np.concatenate(([True], pair_keys[1:] != pair_keys[:-1])))
+	transition_offsets = np.append(state_starts, len(pair_keys)).astype(np.int64)
+	# running totals of the counts, starting over for each state
+	cumulative_weights = np.cumsum(counts)
+	cumulative_weights -= np.repeat(
+		np.concatenate(([0], cumulative_weights[state_starts[1:] - 1])),
+		np.diff(transition_offsets),
+	)
+
+	# the overlap index: every position that starts ANCHOR_SIZE real words, sorted by their hash
+	anchored = np.ones(len(t) - ANCHOR_SIZE + 1, dtype=bool)
+	anchor_keys = np.zeros(len(anchored), dtype=np.uint64)
+	for j, multiplier in enumerate(ANCHOR_MULTIPLIERS[:ANCHOR_SIZE]):
+		window = t[j:len(t) - ANCHOR_SIZE + 1 + j]
+		anchored &= window > END_ID
+		anchor_keys ^= window.astype(np.uint64) * np.uint64(multiplier)
+	anchor_positions = np.flatnonzero(anchored)
+	anchor_keys = anchor_keys[anchor_positions]
+	order = np.argsort(anchor_keys, kind='stable')
+
+	encoded = [(word or '').encode() for word in words]
+	arrays = dict(
+		state_keys=pair_keys[state_starts],
+		transition_offsets=transition_offsets,
+		next_ids=pair_next_ids.astype(np.int32),
+		cumulative_weights=cumulative_weights.astype(np.int64),
+		tokens=tokens,
+		anchor_keys=anchor_keys[order],
+		anchor_positions=anchor_positions[order].astype(np.int64),
+		word_bytes=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+		word_offsets=np.concatenate(([0], np.cumsum([len(word) for word in encoded]))).astype(np.int64),
+		word_lengths=np.array([len(word or '') for word in words], dtype=np.int32),
+	)
+	return CompactModel(arrays, state_size=state_size)
+
+def _padding(offset):
+	return -offset % ALIGNMENT
+
+def save(model, f, *, meta=None):
+	"""write model to f, a file opened for writing in binary mode. meta is any JSON to store alongside it."""
+	layout = {}
+	offset = 0
+	for name, array in model.arrays.items():
+		layout[name] = dict(dtype=array.dtype.str, length=len(array), offset=offset)
+		offset += array.nbytes + _padding(array.nbytes)
+	header = json.dumps(dict(
+		format_version=FORMAT_VERSION,
+		state_size=model.state_size,
+		arrays=layout,
+		meta=meta or {},
+	)).encode()
+
+	f.write(MAGIC)
+	f.write(len(header).to_bytes(8, 'little'))
+	f.write(header)
+	f.write(b'\0' * _padding(len(MAGIC) + 8 + len(header)))
+	for array in model.arrays.values():
+		f.write(np.ascontiguousarray(array).tobytes())
+		f.write(b'\0' * _padding(array.nbytes))
+
+def _read_header(f):
+	if f.read(len(MAGIC)) != MAGIC:
+		raise ValueError('Not a compact markov model')
+	header_length = int.from_bytes(f.read(8), 'little')
+	header = json.loads(f.read(header_length))
+	if header['format_version'] != FORMAT_VERSION:
+		raise ValueError(f'Unsupported compact markov model version {header["format_version"]}')
+	start = len(MAGIC) + 8 + header_length
+	return header, start + _padding(start)
+
+def read_meta(path):
+	"""return the meta passed to save() for the model at path, without loading it"""
+	with open(path, 'rb') as f:
+		return _read_header(f)[0]['meta']
+
+def load(path):
+	"""map the model saved at path into memory"""
+	with open(path, 'rb') as f:
+		header, start = _read_header(f)
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	arrays = {
+		name: np.frombuffer(mm, dtype=layout['dtype'], count=layout['length'], offset=start + layout['offset'])
+		for name, layout in header['arrays'].items()
+	}
+	return CompactModel(arrays, state_size=header['state_size'], meta=header['meta'], mm=mm)
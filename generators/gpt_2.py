@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# generating posts with a GPT-2 style language model from Hugging Face transformers, on the CPU.
+# loading the weights is by far the slowest part, so each process loads them once and keeps them around.
+
+import math
+import time
+import torch
+import metrics
+from random import randint
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+MODEL_LOAD_SECONDS = metrics.histogram('model_load_seconds', 'Time to load a cached model, by generator', ('generator',))
+SENTENCE_SECONDS = metrics.histogram('sentence_seconds', 'Time to generate a sentence, by generator', ('generator',))
+
+# ((model, threads), (tokenizer, model)) that this process is holding on to
+_resident = None
+
+def resident_model(cfg):
+	"""return the tokenizer and model for cfg, loading them only the first time"""
+	global _resident
+	key = cfg['gpt_2_model'], cfg['gpt_2_threads']
+	if _resident is not None and _resident[0] == key:
+		return _resident[1]
+
+	if cfg['gpt_2_threads']:
+		# by default torch uses every core, which is too many if there are several generator processes
+		torch.set_num_threads(cfg['gpt_2_threads'])
+
+	with MODEL_LOAD_SECONDS.time(generator='gpt_2'):
+		tokenizer = AutoTokenizer.from_pretrained(cfg['gpt_2_model'])
+		model = AutoModelForCausalLM.from_pretrained(cfg['gpt_2_model'])
+		model.eval()
+	_resident = key, (tokenizer, model)
+	return tokenizer, model
+
+warm_up = resident_model
+
+def _clean(cfg, text):
+	# a post is whatever comes before the model moves on to something else
+	sentence = ' '.join(text.strip().split('\n', 1)[0].split())
+	if cfg['limit_length']:
+		sentence = ' '.join(sentence.split()[:randint(cfg['length_lower_limit'], cfg['length_upper_limit'])])
+	return sentence
+
+def _generate(cfg, tokenizer, model, batch_size):
+	# every sentence starts from scratch, which for GPT-2 is the end of text token
+	start = tokenizer.bos_token_id if tokenizer.bos_token_id is not None else tokenizer.eos_token_id
+	input_ids = torch.full((batch_size, 1), start, dtype=torch.long)
+	started_at = time.perf_counter()
+	with torch.inference_mode():
+		output = model.generate(
+			input_ids,
+			attention_mask=torch.ones_like(input_ids),
+			do_sample=True,
+			max_new_tokens=cfg['gpt_2_max_tokens'],
+			top_k=cfg['gpt_2_top_k'],
+			temperature=cfg['gpt_2_temperature'],
+			pad_token_id=tokenizer.eos_token_id,
+		)
+	# the whole batch is generated at once, so each sentence took its share of the time
+	elapsed = time.perf_counter() - started_at
+	for _ in range(batch_size):
+		SENTENCE_SECONDS.observe(elapsed / batch_size, generator='gpt_2')
+	return tokenizer.batch_decode(output[:, 1:], skip_special_tokens=True)
+
+def make_sentences(cfg, n):
+	"""generate up to n sentences, gpt_2_batch_size at a time"""
+	tokenizer, model = resident_model(cfg)
+	sentences = []
+	# some outputs are empty, but if most of them are, something's wrong, and trying forever won't fix it
+	for _ in range(3 * math.ceil(n / cfg['gpt_2_batch_size'])):
+		if len(sentences) >= n:
+			break
+		batch_size = min(cfg['gpt_2_batch_size'], n - len(sentences))
+		sentences.extend(filter(None, (_clean(cfg, text) for text in _generate(cfg, tokenizer, model, batch_size))))
+	return sentences[:n]
+
+def make_sentence(cfg):
+	if not (sentences := make_sentences(cfg, 1)):
+		raise ValueError("Failed to produce a sentence!")
+	return sentences[0]
@@ -1,64 +1,467 @@
 # SPDX-License-Identifier: MPL-2.0
 
-import sqlite3
+import gc
+import os
+import json
+import time
+import corpus
+import schema
+import metrics
+import tempfile
 import markovify
+import contextlib
+from random import randint
+from collections import Counter, defaultdict
+from markovify.chain import BEGIN, END
 
-def make_sentence(cfg):
-	class nlt_fixed(markovify.NewlineText):  # modified version of NewlineText that never rejects sentences
-		def test_sentence_input(self, sentence):
-			return True  # all sentences are valid <3
-
-	db = sqlite3.connect(cfg["db_path"])
-	db.text_factory = str
-	c = db.cursor()
-	if cfg['learn_from_cw']:
-		ignored_cws_query_params = "(" + ",".join("?" * len(cfg["ignored_cws"])) + ")"
-		toots = c.execute(
-			f"""
-			SELECT content
-			FROM posts
-			WHERE
-				summary IS NULL
-				OR summary NOT IN {ignored_cws_query_params}
-			ORDER BY RANDOM() LIMIT 10000
-			""",
-			cfg["ignored_cws"],
-		).fetchall()
+# bump this whenever the on-disk model format changes so that old caches get rebuilt
+MODEL_FORMAT_VERSION = 3
+# new posts are added to a model without resampling, so once a model built from a sample of markov_sample_size posts
+# has been extended to more than this many times that, it's rebuilt from a fresh sample instead.
+# that keeps it about the size it's meant to be, and keeps recency_half_life applying to the newer posts too.
+MAX_GROWTH = 2
+# how many walks make_sentence tries before giving up
+MAX_TRIES = 100000
+MAX_CHARS = 500
+# markovify's default
+MAX_OVERLAP_TOTAL = 15
+# how many words the overlap index is keyed by. shorter word sequences are searched for in the whole text instead.
+ANCHOR_SIZE = 3
+# how many overlap lookups are answered by searching the text before it's worth building the index, in processes
+# that weren't warmed up. a one-off gen.py run needs only a few, and building the index for a big corpus takes longer
+# than loading the model. long-lived processes build it in warm_up instead, so that it never holds up a reply.
+INDEX_AFTER_LOOKUPS = 200
+
+MODEL_BUILD_SECONDS = metrics.histogram(
+	'model_build_seconds', 'Time to build the markov model and save it, by whether it was built from scratch', ('kind',),
+)
+MODEL_LOAD_SECONDS = metrics.histogram('model_load_seconds', 'Time to load a cached model, by generator', ('generator',))
+SENTENCE_SECONDS = metrics.histogram('sentence_seconds', 'Time to generate a sentence, by generator', ('generator',))
+GENERATION_TRIES = metrics.counter('generation_tries_total', 'Random walks tried while generating markov sentences')
+GENERATION_REJECTIONS = metrics.counter(
+	'generation_rejections_total', 'Random walks thrown away while generating markov sentences, by reason', ('reason',),
+)
+GENERATION_FAILURES = metrics.counter(
+	'generation_failures_total', 'Times every try at a markov sentence was thrown away',
+)
+
+class nlt_fixed(markovify.NewlineText):  # modified version of NewlineText that never rejects sentences
+	def test_sentence_input(self, sentence):
+		return True  # all sentences are valid <3
+
+# markov_backend: what its models are saved as, next to the posts DB
+MODEL_SUFFIXES = {
+	'markovify': '.model.json',
+	'compact': '.model.chain',
+}
+
+def _compact():
+	# only the compact backend needs numpy
+	from generators import compact
+	return compact
+
+def model_path(cfg):
+	"""where the compiled model for this config lives. defaults to right next to the posts DB."""
+	return cfg.get('model_path') or cfg['db_path'] + MODEL_SUFFIXES[cfg['markov_backend']]
+
+def model_settings(cfg):
+	"""the config values that affect what the model is built from. if any of these change, the model is rebuilt."""
+	return dict(
+		format_version=MODEL_FORMAT_VERSION,
+		backend=cfg['markov_backend'],
+		sample_size=cfg['markov_sample_size'],
+		overlap_ratio_enabled=cfg['overlap_ratio_enabled'],
+		recency_half_life=cfg['recency_half_life'],
+		**corpus.learnable_settings(cfg),
+	)
+
+def corpus_watermark(db):
+	"""return a summary of the posts table that changes whenever posts are added or removed"""
+	max_rowid, count, max_published_at = db.execute(
+		'SELECT coalesce(max(rowid), 0), count(*), max(published_at) FROM posts',
+	).fetchone()
+	return dict(max_rowid=max_rowid, count=count, max_published_at=max_published_at)
+
+def _text(toots):
+	# TODO support replicating \n in output posts instead of squashing them together
+	return "\n".join(toot.replace('\n', ' ') for toot in toots)
+
+def _text_model(cfg, toots, *, base=None):
+	"""return a model of toots. if base is passed, the model also includes everything in base."""
+	nlt = markovify.NewlineText if cfg['overlap_ratio_enabled'] else nlt_fixed
+	if cfg['markov_backend'] == 'compact':
+		# only markovify's parsing is used here, so skip __init__, which would build a whole chain
+		parser = nlt.__new__(nlt)
+		parser.well_formed = True
+		return _compact().build(parser.generate_corpus(_text(toots)), base=base)
+
+	model = nlt(_text(toots))
+	return model if base is None else markovify.combine([_decompiled(base), model])
+
+def _decompiled(model):
+	"""turn a model loaded from a compiled cache back into counts, which is what markovify.combine works with"""
+	chain = model.chain
+	if chain.compiled:
+		chain.model = {
+			state: dict(zip(words, (b - a for a, b in zip([0, *cumdist], cumdist))))
+			for state, (words, cumdist) in chain.model.items()
+		}
+		chain.compiled = False
+		chain.precompute_begin_state()
+	return model
+
+def _build_model(cfg, db):
+	"""return a new model, and how many posts it was learned from"""
+	if (sample_size := cfg['markov_sample_size']) is None:
+		toots = [toot for toot, in db.execute('SELECT content FROM posts WHERE learnable = 1')]
 	else:
-		toots = c.execute(
-			"""
-			SELECT content
-			FROM posts
-			WHERE summary IS NULL
-			ORDER BY RANDOM()
-			LIMIT 10000
-			""",
-		).fetchall()
+		half_life = cfg['recency_half_life'] and cfg['recency_half_life'] * 24 * 60 * 60
+		toots = corpus.sample(db, sample_size, half_life=half_life)
 
 	if not toots:
-		raise ValueError("Database is empty! Try running main.py.")
+		raise ValueError("Database is empty! Try running fetch_posts.py.")
+
+	return _text_model(cfg, toots), len(toots)
+
+def _new_toots(db, since_rowid):
+	"""return all learnable posts inserted after since_rowid"""
+	return [toot for toot, in db.execute('SELECT content FROM posts WHERE rowid > ? AND learnable = 1', (since_rowid,))]
+
+def _extend_model(cfg, model, toots):
+	"""return model with toots added to it"""
+	if not toots:
+		return model
+
+	return _text_model(cfg, toots, base=model)
+
+def _read_cache(cfg):
+	"""return the settings and watermark the cached model was built with, how many posts it was learned from,
+	and for markovify, the model itself
+	"""
+	try:
+		if cfg['markov_backend'] == 'compact':
+			return _compact().read_meta(model_path(cfg))
+		with open(model_path(cfg)) as f:
+			return json.load(f)
+	except (FileNotFoundError, ValueError):
+		return None
 
+def _write_cache(cfg, model, watermark, posts):
+	"""save model, returning it the way generators load it"""
+	path = model_path(cfg)
+	meta = dict(settings=model_settings(cfg), watermark=watermark, posts=posts)
+	# every worker in a GeneratorPool may be building the same model at once, so each one writes its own file
+	fd, tmp_path = tempfile.mkstemp(
+		dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp',
+	)
+	try:
+		if cfg['markov_backend'] == 'compact':
+			with open(fd, 'wb') as f:
+				_compact().save(model, f, meta=meta)
+		else:
+			with open(fd, 'w') as f:
+				# saved compiled, so that loading it is all generators have to do. it's decompiled again to be extended.
+				model = model.compile(inplace=False)
+				json.dump(dict(meta, model=model.to_dict()), f)
+		# atomic so that a generator never sees a half-written model
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.unlink(tmp_path)
+		raise
+
+	if cfg['markov_backend'] == 'compact':
+		# compact models are used straight from the file
+		return _compact().load(path)
+	return model
+
+def _model_from_cache(cfg, cache):
+	if cfg['markov_backend'] == 'compact':
+		return _compact().load(model_path(cfg))
 	nlt = markovify.NewlineText if cfg['overlap_ratio_enabled'] else nlt_fixed
+	return nlt.from_dict(cache['model'])
 
-	# TODO support replicating \n in output posts instead of squashing them together
-	model = nlt("\n".join(toot[0].replace('\n', ' ') for toot in toots))
+def update_model(cfg, *, rebuild=False):
+	"""Bring the on-disk model up to date with the posts DB.
+
+	If the cached model was built with the same settings and posts have only been added since,
+	the new posts are merged into it, unless that would grow a sampled model past MAX_GROWTH times its sample size.
+	Otherwise, or if rebuild is true, the model is rebuilt from a fresh sample.
+	Returns the model the way load_model would, or None if it was already up to date.
+	"""
+	start = time.perf_counter()
+	db = schema.connect(cfg['db_path'])
+	try:
+		corpus.update_learnable(cfg, db)
+		watermark = corpus_watermark(db)
+		cache = _read_cache(cfg)
+		if (
+			rebuild
+			or cache is None
+			or cache['settings'] != model_settings(cfg)
+			# posts were deleted, so the model may contain things that shouldn't be learned from anymore
+			or watermark['max_rowid'] < cache['watermark']['max_rowid']
+			or watermark['count'] < cache['watermark']['count']
+		):
+			kind = 'build'
+		elif watermark == cache['watermark']:
+			return None
+		else:
+			toots = _new_toots(db, cache['watermark']['max_rowid'])
+			posts = cache['posts'] + len(toots)
+			sample_size = cfg['markov_sample_size']
+			kind = 'build' if sample_size is not None and posts > MAX_GROWTH * sample_size else 'extend'
+
+		if kind == 'build':
+			model, posts = _build_model(cfg, db)
+		else:
+			model = _extend_model(cfg, _model_from_cache(cfg, cache), toots)
+	finally:
+		db.close()
+
+	model = _write_cache(cfg, model, watermark, posts)
+	MODEL_BUILD_SECONDS.observe(time.perf_counter() - start, kind=kind)
+	return model
 
-	db.close()
+@contextlib.contextmanager
+def _gc_paused():
+	# parsing a model creates millions of objects that are never garbage,
+	# and the collector going over all of them again and again takes longer than the parsing
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable()
+
+def load_model(cfg):
+	"""return the compiled model for cfg, only building it if there is no usable cached model"""
+	with _gc_paused():
+		cache = _read_cache(cfg)
+	if cache is None or cache['settings'] != model_settings(cfg):
+		# returned as is, since another process building the same model may replace the file at any moment
+		if (model := update_model(cfg)) is not None:
+			return model
+		# someone else brought it up to date in the meantime
+		with _gc_paused():
+			cache = _read_cache(cfg)
+
+	with MODEL_LOAD_SECONDS.time(generator='markov'), _gc_paused():
+		# markovify models are cached compiled, and compact models are always ready to use
+		return _model_from_cache(cfg, cache)
+
+class OverlapIndex:
+	"""Answers whether a sequence of words appears in the text a model was learned from.
+
+	Unless build() is called first, the first INDEX_AFTER_LOOKUPS lookups search the text. After that, every position
+	in the text is indexed by the words that start there, so a lookup only has to compare the few places that start
+	the same way.
+	"""
+
+	def __init__(self, model):
+		self._sentences = model.parsed_sentences
+		self._rejoined_text = model.rejoined_text
+		# hash of ANCHOR_SIZE words: [(sentence index, offset)], once there have been enough lookups to pay for it
+		self._anchors = None
+		self._lookups = 0
+
+	def build(self):
+		if self._anchors is not None:
+			return
+		anchors = defaultdict(list)
+		for i, sentence in enumerate(self._sentences):
+			for offset in range(len(sentence) - ANCHOR_SIZE + 1):
+				anchors[hash(tuple(sentence[offset:offset + ANCHOR_SIZE]))].append((i, offset))
+		self._anchors = anchors
+
+	def _search(self, words):
+		# whole words only, same as the index. words never contain whitespace, and sentences are one per line.
+		text = self._rejoined_text
+		phrase = ' '.join(words)
+		start = 0
+		while (i := text.find(phrase, start)) != -1:
+			end = i + len(phrase)
+			if (i == 0 or text[i - 1] in ' \n') and (end == len(text) or text[end] in ' \n'):
+				return True
+			start = i + 1
+		return False
+
+	def __contains__(self, words):
+		if len(words) < ANCHOR_SIZE:
+			return ' '.join(words) in self._rejoined_text
+		if self._anchors is None:
+			self._lookups += 1
+			if self._lookups <= INDEX_AFTER_LOOKUPS:
+				return self._search(words)
+			self.build()
+		return any(
+			self._sentences[i][offset:offset + len(words)] == words
+			for i, offset in self._anchors.get(hash(tuple(words[:ANCHOR_SIZE])), ())
+		)
+
+class GenerationStats:
+	"""what it took to generate sentences in this process"""
+	def __init__(self):
+		self.sentences = 0
+		self.failures = 0
+		self.tries = 0
+		# reason: how many walks were thrown away for it
+		self.rejections = Counter()
+		self.time = 0
+
+	def as_dict(self):
+		return dict(
+			sentences=self.sentences,
+			failures=self.failures,
+			tries=self.tries,
+			rejections=dict(self.rejections),
+			seconds_per_sentence=self.time / self.sentences if self.sentences else None,
+		)
+
+	def __str__(self):
+		per_sentence = f'{self.time / self.sentences * 1000:.2f}ms' if self.sentences else 'n/a'
+		rejections = ', '.join(f'{count} {reason}' for reason, count in self.rejections.most_common()) or 'none'
+		return (
+			f'{self.sentences} sentences ({self.failures} failures) in {self.tries} tries, {per_sentence} each. '
+			f'rejections: {rejections}'
+		)
+
+stats = GenerationStats()
+
+class SentenceGenerator:
+	"""Walks a compiled model's chain directly, so that sentences that are too long get thrown away as soon as
+	they are, rather than after they've been generated in full.
+	"""
+
+	def __init__(self, model):
+		self.model = model
+		if isinstance(model, markovify.Text):
+			self._move = model.chain.move
+			self._begin_state = (BEGIN,) * model.chain.state_size
+			self._end = END
+			self._word_length = len
+			self._join = model.word_join
+			# models without the original text can't be checked for overlap, same as with markovify
+			self.overlap_index = OverlapIndex(model) if getattr(model, 'parsed_sentences', None) else None
+		else:
+			# a compact.CompactModel, which works with word IDs instead of words
+			self._move = model.move
+			self._begin_state = model.begin_state
+			self._end = model.end
+			self._word_length = model.word_length
+			self._join = model.join
+			self.overlap_index = model.overlap_index
+
+	def _walk(self, max_chars, max_words):
+		"""return the words of a new sentence, or the reason it was rejected"""
+		state = self._begin_state
+		words = []
+		# counting the spaces between words
+		chars = -1
+		while (word := self._move(state)) != self._end:
+			words.append(word)
+			if max_words is not None and len(words) > max_words:
+				return 'too many words'
+			if (chars := chars + self._word_length(word) + 1) > max_chars:
+				return 'too long'
+			state = state[1:] + (word,)
+		return words
+
+	def _overlaps(self, words, max_overlap_ratio):
+		# the same test as markovify's test_sentence_output, except that it only matches whole words
+		overlap_max = min(MAX_OVERLAP_TOTAL, round(max_overlap_ratio * len(words)))
+		overlap_over = overlap_max + 1
+		gram_count = max(len(words) - overlap_max, 1)
+		return any(words[i:i + overlap_over] in self.overlap_index for i in range(gram_count))
+
+	def make_sentence(self, *, max_chars, max_words=None, max_overlap_ratio, tries=MAX_TRIES):
+		"""return a sentence, or None if none of tries walks made an acceptable one"""
+		start = time.perf_counter()
+		# counted here and added up at the end, since updating metrics on every walk would be a lot slower than the walks
+		rejections = Counter()
+		sentence = None
+		try:
+			for _ in range(tries):
+				if isinstance(words := self._walk(max_chars, max_words), str):
+					rejections[words] += 1
+				elif not words:
+					rejections['empty'] += 1
+				elif self.overlap_index is not None and self._overlaps(words, max_overlap_ratio):
+					rejections['overlap'] += 1
+				else:
+					sentence = self._join(words)
+					return sentence
+			return None
+		finally:
+			elapsed = time.perf_counter() - start
+			walks = sum(rejections.values()) + (sentence is not None)
+			if sentence is None:
+				stats.failures += 1
+				GENERATION_FAILURES.inc()
+			else:
+				stats.sentences += 1
+			stats.time += elapsed
+			stats.tries += walks
+			stats.rejections.update(rejections)
+			SENTENCE_SECONDS.observe(elapsed, generator='markov')
+			GENERATION_TRIES.inc(walks)
+			for reason, count in rejections.items():
+				GENERATION_REJECTIONS.inc(count, reason=reason)
+
+# (path, file identity, generator) of the model this process is holding on to
+_resident = None
+# whether this process indexes every model it loads right away. see warm_up.
+_index_eagerly = False
+
+def _file_identity(path):
+	try:
+		st = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return st.st_ino, st.st_mtime_ns
+
+def resident_generator(cfg):
+	"""return a SentenceGenerator for cfg's model, keeping it loaded between calls.
+
+	The model file is replaced atomically whenever it's updated,
+	so a cheap stat is enough to notice that we need to swap in the new one.
+	"""
+	global _resident
+	path = model_path(cfg)
+	if _resident is not None and _resident[:2] == (path, _file_identity(path)):
+		return _resident[2]
+
+	generator = SentenceGenerator(load_model(cfg))
+	if _index_eagerly and isinstance(generator.overlap_index, OverlapIndex):
+		generator.overlap_index.build()
+	# only looked at now, since loading the model may have been what wrote the file
+	_resident = path, _file_identity(path), generator
+	return generator
+
+def resident_model(cfg):
+	return resident_generator(cfg).model
+
+def warm_up(cfg):
+	"""load the model in a long-lived process, such as a GeneratorPool worker.
+	from then on, this process builds the overlap index of every model it loads up front, instead of mid-sentence.
+	"""
+	global _index_eagerly
+	_index_eagerly = True
+	# this process may already have loaded the model without indexing it
+	if isinstance(index := resident_generator(cfg).overlap_index, OverlapIndex):
+		index.build()
+
+def make_sentence(cfg):
+	generator = resident_generator(cfg)
 
 	if cfg['limit_length']:
 		sentence_len = randint(cfg['length_lower_limit'], cfg['length_upper_limit'])
 
-	sentence = None
-	tries = 0
-	for tries in range(10):
-		if (sentence := model.make_short_sentence(
-			max_chars=500,
-			tries=10000,
-			max_overlap_ratio=cfg['overlap_ratio'] if cfg['overlap_ratio_enabled'] else 0.7,
-			max_words=sentence_len if cfg['limit_length'] else None
-		)) is not None:
-			break
-	else:
-		raise ValueError("Failed 10 times to produce a sentence!")
+	if (sentence := generator.make_sentence(
+		max_chars=MAX_CHARS,
+		max_overlap_ratio=cfg['overlap_ratio'] if cfg['overlap_ratio_enabled'] else 0.7,
+		max_words=sentence_len if cfg['limit_length'] else None,
+	)) is None:
+		raise ValueError(f"Failed {MAX_TRIES} times to produce a sentence!")
 
 	return sentence
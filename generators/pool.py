@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import anyio
+import metrics
+import importlib
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+
+def generator_module(mode):
+	"""return the module implementing TextGenerationMode mode"""
+	return importlib.import_module(f'generators.{mode.name}')
+
+# the config this worker process was started with
+_cfg = None
+
+def _init_worker(cfg, mode):
+	global _cfg
+	_cfg = cfg
+	generator = generator_module(mode)
+	# load the model up front so that the first request doesn't have to wait for it
+	if (warm_up := getattr(generator, 'warm_up', None)) is not None:
+		try:
+			warm_up(cfg)
+		except Exception:
+			# an exception here would break the whole pool for good.
+			# let it happen again on the first request instead, where the caller can see it.
+			import traceback
+			traceback.print_exc()
+
+def _make_sentence(mode):
+	return generator_module(mode).make_sentence(_cfg)
+
+def _make_sentences(mode, n):
+	generator = generator_module(mode)
+	# generators that can do better than one at a time (e.g. batched inference) provide make_sentences
+	if (make_sentences := getattr(generator, 'make_sentences', None)) is not None:
+		return make_sentences(_cfg, n)
+
+	sentences = []
+	for _ in range(n):
+		try:
+			sentences.append(generator.make_sentence(_cfg))
+		except ValueError:
+			# failing to come up with a sentence is fine when making lots of them
+			continue
+	return sentences
+
+def _ping():
+	pass
+
+class GeneratorPool:
+	"""A fixed set of long-lived worker processes that keep the generator's model loaded between calls.
+
+	Use as an async context manager. Each worker reloads its model by itself when the model on disk changes.
+	"""
+
+	def __init__(self, cfg, *, mode=None, workers=None):
+		self.cfg = cfg
+		self.mode = mode or cfg['generation_mode']
+		self.workers = workers or cfg['generator_workers'] or os.cpu_count()
+		# bounds the number of outstanding jobs so that callers wait here instead of piling up in the executor
+		self._limiter = anyio.CapacityLimiter(self.workers)
+		self._restart_lock = anyio.Lock()
+
+	async def __aenter__(self):
+		self._executor = await self._start()
+		return self
+
+	async def _start(self):
+		executor = concurrent.futures.ProcessPoolExecutor(
+			max_workers=self.workers,
+			# forking a process that has an event loop and threads running is asking for trouble
+			mp_context=multiprocessing.get_context('spawn'),
+			initializer=_init_worker,
+			initargs=(self.cfg, self.mode),
+		)
+		# start every worker now rather than on first use
+		await anyio.to_thread.run_sync(
+			concurrent.futures.wait,
+			[executor.submit(_ping) for _ in range(self.workers)],
+		)
+		return executor
+
+	async def __aexit__(self, *excinfo):
+		# nothing is queued in the executor past what's running, thanks to _limiter, so this only waits for that
+		await anyio.to_thread.run_sync(self._executor.shutdown)
+
+	async def _restart(self, broken):
+		async with self._restart_lock:
+			# every job that was running when a worker died finds out at once, but only one of them needs to do this
+			if self._executor is not broken:
+				return
+			print('A generator worker died, starting new ones')
+			broken.shutdown(wait=False)
+			self._executor = await self._start()
+
+	async def _submit(self, func, *args):
+		return await anyio.to_thread.run_sync(self._executor.submit(metrics.with_metrics, func, *args).result)
+
+	async def run(self, func, *args):
+		async with self._limiter:
+			executor = self._executor
+			try:
+				result, worker_metrics = await self._submit(func, *args)
+			except concurrent.futures.process.BrokenProcessPool:
+				# a worker dying (e.g. running out of memory) leaves the whole executor unusable for good
+				await self._restart(executor)
+				result, worker_metrics = await self._submit(func, *args)
+		metrics.merge(worker_metrics)
+		return result
+
+	async def make_sentence(self):
+		return await self.run(_make_sentence, self.mode)
+
+	async def make_sentences(self, n):
+		return await self.run(_make_sentences, self.mode, n)
@@ -0,0 +1,282 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# counters and histograms shared by fetch_posts.py, gen.py and reply.py.
+# they're exposed in the Prometheus text format on a local port (metrics_port), and/or logged to stderr as a line of
+# JSON every metrics_log_interval seconds and once more on exit. metrics recorded in worker processes are sent back
+# to the main process with each result (see take and merge).
+# there's also a sampling profiler (profile_output), which writes stacks in the folded format that flamegraph.pl and
+# speedscope read.
+
+import sys
+import json
+import time
+import anyio
+import signal
+import threading
+import contextlib
+from collections import Counter as _Counter
+
+# in seconds. fine enough for a single HTTP request or sentence, long enough for building a model.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_lock = threading.Lock()
+# name: metric
+REGISTRY = {}
+
+class _Metric:
+	kind = None
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(labels)
+		# tuple of label values: value
+		self._values = {}
+
+	def _key(self, labels):
+		if labels.keys() != set(self.label_names):
+			raise ValueError(f'{self.name} takes the labels {self.label_names}, not {tuple(labels)}')
+		return tuple(str(labels[name]) for name in self.label_names)
+
+	def _labels(self, key, **extra):
+		pairs = [*zip(self.label_names, key), *extra.items()]
+		if not pairs:
+			return ''
+		return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class Counter(_Metric):
+	kind = 'counter'
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		with _lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+	def _merge(self, key, value):
+		self._values[key] = self._values.get(key, 0) + value
+
+	def _prometheus(self):
+		for key, value in self._values.items():
+			yield f'{self.name}{self._labels(key)} {value}'
+
+	def _json(self, key, value):
+		return dict(value=value)
+
+class Histogram(_Metric):
+	kind = 'histogram'
+
+	def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+		super().__init__(name, help, labels)
+		self.buckets = tuple(buckets)
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+		with _lock:
+			if (state := self._values.get(key)) is None:
+				# how many observations fell in each bucket (not cumulative, with one more for +Inf), the sum, the count
+				state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+			counts = state[0]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[i] += 1
+					break
+			else:
+				counts[-1] += 1
+			state[1] += value
+			state[2] += 1
+
+	@contextlib.contextmanager
+	def time(self, **labels):
+		"""observe how many seconds the block takes"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start, **labels)
+
+	def _merge(self, key, value):
+		if (state := self._values.get(key)) is None:
+			self._values[key] = [list(value[0]), value[1], value[2]]
+			return
+		state[0] = [a + b for a, b in zip(state[0], value[0])]
+		state[1] += value[1]
+		state[2] += value[2]
+
+	def _cumulative(self, counts):
+		total = 0
+		for bound, count in zip((*self.buckets, '+Inf'), counts):
+			total += count
+			yield bound, total
+
+	def _prometheus(self):
+		for key, (counts, sum_, count) in self._values.items():
+			for bound, total in self._cumulative(counts):
+				yield f'{self.name}_bucket{self._labels(key, le=bound)} {total}'
+			yield f'{self.name}_sum{self._labels(key)} {sum_}'
+			yield f'{self.name}_count{self._labels(key)} {count}'
+
+	def _json(self, key, value):
+		counts, sum_, count = value
+		return dict(count=count, sum=sum_, buckets=dict((str(bound), total) for bound, total in self._cumulative(counts)))
+
+def _escape(value):
+	return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _register(cls, name, *args, **kwargs):
+	with _lock:
+		if (metric := REGISTRY.get(name)) is None:
+			metric = REGISTRY[name] = cls(name, *args, **kwargs)
+	if not isinstance(metric, cls):
+		raise ValueError(f'{name} is already a {metric.kind}')
+	return metric
+
+def counter(name, help, labels=()):
+	"""return the counter called name, creating it if necessary"""
+	return _register(Counter, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+	"""return the histogram called name, creating it if necessary"""
+	return _register(Histogram, name, help, labels, buckets)
+
+def prometheus_text():
+	"""every metric in the Prometheus text exposition format"""
+	lines = []
+	with _lock:
+		for metric in REGISTRY.values():
+			lines.append(f'# HELP {metric.name} {metric.help}')
+			lines.append(f'# TYPE {metric.name} {metric.kind}')
+			lines.extend(metric._prometheus())
+	return '\n'.join(lines) + '\n'
+
+def snapshot():
+	"""every metric that has been recorded, as JSON-serializable dicts"""
+	with _lock:
+		return {
+			metric.name: [
+				dict(labels=dict(zip(metric.label_names, key)), **metric._json(key, value))
+				for key, value in metric._values.items()
+			]
+			for metric in REGISTRY.values()
+			if metric._values
+		}
+
+def take():
+	"""return what's been recorded since the last call, and start over. for worker processes to send back."""
+	with _lock:
+		taken = [
+			(type(metric), metric.name, metric.help, metric.label_names, getattr(metric, 'buckets', None), metric._values)
+			for metric in REGISTRY.values()
+			if metric._values
+		]
+		for metric in REGISTRY.values():
+			metric._values = {}
+	return taken
+
+def merge(taken):
+	"""add what take() returned in another process to this one's metrics"""
+	for cls, name, help, label_names, buckets, values in taken:
+		kwargs = {} if buckets is None else dict(buckets=buckets)
+		metric = _register(cls, name, help, label_names, **kwargs)
+		with _lock:
+			for key, value in values.items():
+				metric._merge(key, value)
+
+def with_metrics(func, *args):
+	"""call func in a worker process, returning its result along with the metrics it recorded"""
+	return func(*args), take()
+
+def log():
+	print(json.dumps(dict(time=time.time(), metrics=snapshot())), file=sys.stderr, flush=True)
+
+async def _log_periodically(interval):
+	while True:
+		await anyio.sleep(interval)
+		log()
+
+async def _serve(port):
+	from aiohttp import web
+
+	async def handle(request):
+		return web.Response(text=prometheus_text(), content_type='text/plain', charset='utf-8')
+
+	app = web.Application()
+	app.router.add_get('/metrics', handle)
+	runner = web.AppRunner(app, handle_signals=False)
+	await runner.setup()
+	try:
+		# only locally, since there's no authentication
+		await web.TCPSite(runner, '127.0.0.1', port).start()
+		await anyio.sleep_forever()
+	finally:
+		with anyio.CancelScope(shield=True):
+			await runner.cleanup()
+
+class Profiler:
+	"""Samples the stack of every thread in this process every interval seconds, from a background thread.
+
+	Stacks are counted in the folded format: one line per distinct stack, frames separated by semicolons,
+	followed by how many times it was seen.
+	"""
+
+	def __init__(self, path, *, interval):
+		self.path = path
+		self.interval = interval
+		self._samples = _Counter()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			names = {thread.ident: thread.name for thread in threading.enumerate()}
+			for ident, frame in sys._current_frames().items():
+				if ident == self._thread.ident:
+					continue
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+					frame = frame.f_back
+				stack.append(names.get(ident, str(ident)))
+				self._samples[';'.join(reversed(stack))] += 1
+
+	def start(self):
+		self._thread.start()
+
+	def write(self):
+		"""write the samples so far to path"""
+		with open(self.path, 'w') as f:
+			for stack, count in self._samples.most_common():
+				print(stack, count, file=f)
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+		self.write()
+
+@contextlib.asynccontextmanager
+async def reporting(cfg):
+	"""Expose metrics the ways cfg says to while the block runs, logging them one last time at the end.
+	If profile_output is set, the block is also profiled, and on SIGUSR2 the samples so far are written out.
+	"""
+	profiler = None
+	if cfg['profile_output']:
+		profiler = Profiler(cfg['profile_output'], interval=cfg['profile_interval'])
+		profiler.start()
+		if hasattr(signal, 'SIGUSR2'):
+			signal.signal(signal.SIGUSR2, lambda *_: profiler.write())
+
+	try:
+		async with anyio.create_task_group() as tg:
+			if cfg['metrics_port'] is not None:
+				tg.start_soon(_serve, cfg['metrics_port'])
+			if cfg['metrics_log_interval']:
+				tg.start_soon(_log_periodically, cfg['metrics_log_interval'])
+			try:
+				yield
+			finally:
+				tg.cancel_scope.cancel()
+	finally:
+		if cfg['metrics_log_interval']:
+			log()
+		if profiler is not None:
+			profiler.stop()
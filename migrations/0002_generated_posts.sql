@@ -0,0 +1,11 @@
+-- sentences generated ahead of time by `gen.py --batch`, waiting to be posted
+CREATE TABLE generated_posts (
+	id INTEGER PRIMARY KEY,
+	content TEXT NOT NULL,
+	-- name of the TextGenerationMode that generated this
+	generation_mode TEXT NOT NULL,
+	-- UTC Unix timestamp in seconds
+	generated_at REAL NOT NULL
+);
+
+CREATE INDEX generated_posts_generation_mode_idx ON generated_posts (generation_mode, id);
@@ -0,0 +1,22 @@
+-- where syncing each account's outbox left off, so that an interrupted fetch can pick up where it stopped
+CREATE TABLE fetch_state (
+	-- username@instance
+	account TEXT PRIMARY KEY NOT NULL,
+	outbox_url TEXT,
+	-- the outbox's totalItems as of the last sync
+	total_items INTEGER,
+	-- how many outbox items of any type we've gone through. if this is short of total_items, we missed some.
+	items_seen INTEGER NOT NULL DEFAULT 0,
+	-- how far short of total_items the last complete sync came, since totalItems also counts posts we can't see
+	-- (e.g. followers-only ones). anything beyond this is a gap.
+	hidden_items INTEGER NOT NULL DEFAULT 0,
+	-- IDs of the newest and oldest outbox items we've gone through
+	newest_id TEXT,
+	oldest_id TEXT,
+	-- URL of the next (older) page to backfill from
+	tail_cursor TEXT,
+	-- whether we've ever made it to the end of the outbox
+	backfill_complete INTEGER NOT NULL DEFAULT 0,
+	-- UTC Unix timestamp in seconds
+	synced_at REAL
+);
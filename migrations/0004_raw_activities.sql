@@ -0,0 +1,7 @@
+-- the Create activity of every post, exactly as it was fetched,
+-- so that the posts table can be rebuilt (see reextract.py) without refetching everything
+CREATE TABLE raw_activities (
+	post_id TEXT PRIMARY KEY NOT NULL,
+	-- zlib compressed JSON
+	activity BLOB NOT NULL
+);
@@ -0,0 +1,7 @@
+-- HTTP validators from the last time we fetched each account's outbox and its first page,
+-- so that unchanged accounts can be answered with a 304 instead of the whole thing
+ALTER TABLE fetch_state ADD COLUMN outbox_etag TEXT;
+ALTER TABLE fetch_state ADD COLUMN outbox_last_modified TEXT;
+ALTER TABLE fetch_state ADD COLUMN first_page_url TEXT;
+ALTER TABLE fetch_state ADD COLUMN first_page_etag TEXT;
+ALTER TABLE fetch_state ADD COLUMN first_page_last_modified TEXT;
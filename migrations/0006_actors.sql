@@ -0,0 +1,11 @@
+-- what fingering each account turned up, so that it doesn't have to be done on every fetch.
+-- if error is not null, resolving the account failed, and it isn't tried again until the entry expires.
+CREATE TABLE actors (
+	handle TEXT PRIMARY KEY NOT NULL,
+	actor_url TEXT,
+	outbox_url TEXT,
+	-- the scheme WebFinger worked over
+	scheme TEXT,
+	error TEXT,
+	resolved_at REAL NOT NULL
+);
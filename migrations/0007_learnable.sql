@@ -0,0 +1,12 @@
+-- whether each post may be learned from under the current learn_from_cw and ignored_cws settings.
+-- NULL means it hasn't been worked out yet, e.g. because the post was just fetched. see corpus.py.
+ALTER TABLE posts ADD COLUMN learnable INTEGER;
+
+CREATE INDEX posts_learnable_published_at_idx ON posts (learnable, published_at);
+
+-- settings that the data in other tables depends on, e.g. which settings posts.learnable was worked out with
+CREATE TABLE meta (
+	key TEXT PRIMARY KEY NOT NULL,
+	-- JSON
+	value TEXT NOT NULL
+);
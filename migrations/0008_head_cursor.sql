@@ -0,0 +1,5 @@
+-- where an interrupted fetch of new posts left off, so that the next sync finishes it instead of stopping at the
+-- posts it already saved, which would leave a gap between those and newest_id
+ALTER TABLE fetch_state ADD COLUMN head_cursor TEXT;
+-- the newest outbox item when that fetch started, which becomes newest_id once it's done
+ALTER TABLE fetch_state ADD COLUMN head_newest_id TEXT;
@@ -0,0 +1,186 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# per-host rate limiting and retries for fetch_posts.py.
+# each host gets a token bucket that starts out at a conservative rate and then follows whatever the host's
+# X-RateLimit-* headers say it allows. requests that fail in ways that are usually temporary are retried with
+# jittered exponential backoff.
+
+import time
+import anyio
+import random
+import asyncio
+import aiohttp
+import metrics
+import pendulum
+import contextlib
+from yarl import URL
+from http import HTTPStatus
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+
+# statuses that mean "try again later"
+RETRY_STATUSES = frozenset({
+	HTTPStatus.TOO_MANY_REQUESTS,
+	HTTPStatus.INTERNAL_SERVER_ERROR,
+	HTTPStatus.BAD_GATEWAY,
+	HTTPStatus.SERVICE_UNAVAILABLE,
+	HTTPStatus.GATEWAY_TIMEOUT,
+})
+# retrying anything else could do it twice
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+# how many requests' worth of the host's limit to leave alone, in case something else is using it too
+HEADROOM = 1
+
+REQUEST_SECONDS = metrics.histogram('http_request_seconds', 'Time until response headers, by host', ('host',))
+RESPONSES = metrics.counter(
+	'http_responses_total', 'Responses by host and status, or "error" for connection errors and timeouts', ('host', 'status'),
+)
+RETRIES = metrics.counter('http_retries_total', 'Requests retried, by host', ('host',))
+
+def _seconds_until(value, now=None):
+	"""parse a reset time from a rate limit header, which may be a date or a number of seconds,
+	returning how many seconds away it is, or None if it can't be parsed
+	"""
+	now = time.time() if now is None else now
+	try:
+		number = float(value)
+	except ValueError:
+		pass
+	else:
+		# some servers send a Unix timestamp instead of a delay
+		return max(0, number - now if number > 1e9 else number)
+
+	try:
+		reset = parsedate_to_datetime(value).timestamp()
+	except (TypeError, ValueError):
+		try:
+			reset = pendulum.parse(value).timestamp()
+		except ValueError:
+			return None
+	return max(0, reset - now)
+
+def retry_after(headers):
+	"""return how long headers say to wait before trying again, or None if they don't say"""
+	if (value := headers.get('Retry-After')) is not None:
+		return _seconds_until(value)
+	if headers.get('X-RateLimit-Remaining') == '0' and (reset := headers.get('X-RateLimit-Reset')) is not None:
+		return _seconds_until(reset)
+	return None
+
+class HostLimiter:
+	"""a token bucket for requests to a single host"""
+
+	def __init__(self, *, rate, burst):
+		self.default_rate = self.rate = rate
+		self.burst = burst
+		self._tokens = burst
+		self._updated = time.monotonic()
+		self._paused_until = 0
+
+	def _refill(self, now):
+		self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	async def acquire(self):
+		while True:
+			now = time.monotonic()
+			if now < self._paused_until:
+				await anyio.sleep(self._paused_until - now)
+				continue
+
+			self._refill(now)
+			if self._tokens >= 1:
+				self._tokens -= 1
+				return
+			await anyio.sleep((1 - self._tokens) / self.rate)
+
+	def pause(self, seconds):
+		"""stop handing out tokens for the next seconds seconds"""
+		self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+		self._tokens = 0
+
+	def update(self, headers):
+		"""adjust to the rate limit that response headers say is in effect"""
+		try:
+			remaining = int(headers['X-RateLimit-Remaining'])
+		except (KeyError, ValueError):
+			return
+
+		remaining = max(0, remaining - HEADROOM)
+		reset = headers.get('X-RateLimit-Reset')
+		if (window := reset and _seconds_until(reset)) is None or not window:
+			return
+
+		if not remaining:
+			self.pause(window)
+			return
+
+		# spread what's left over the rest of the window, but never go slower than we would've anyway,
+		# since then we'd just end the window with requests left over
+		self.rate = max(self.default_rate, remaining / window)
+		self._refill(time.monotonic())
+		self._tokens = min(self._tokens, remaining)
+
+class RateLimiter:
+	"""Make requests through an aiohttp session that has raise_for_status set,
+	holding each host to its rate limit and retrying temporary failures.
+	"""
+
+	def __init__(self, http, *, rate, burst, max_retries, max_backoff):
+		self._http = http
+		self.max_retries = max_retries
+		self.max_backoff = max_backoff
+		self._limiters = defaultdict(lambda: HostLimiter(rate=rate, burst=burst))
+		self.retries = 0
+
+	def _backoff(self, attempt):
+		# full jitter, so that everything that failed at once doesn't retry at once
+		return random.uniform(0, min(self.max_backoff, 2 ** attempt))
+
+	@contextlib.asynccontextmanager
+	async def request(self, method, url, *, retries=None, **kwargs):
+		"""like aiohttp.ClientSession.request, but waits for the host's rate limit and retries temporary failures.
+		If retries is passed, it overrides max_retries for this request.
+		"""
+		host = URL(url).host
+		limiter = self._limiters[host]
+		max_retries = self.max_retries if retries is None else retries
+		if method.upper() not in IDEMPOTENT_METHODS:
+			max_retries = 0
+
+		attempt = 0
+		while True:
+			await limiter.acquire()
+			start = time.perf_counter()
+			try:
+				resp = await self._http.request(method, url, **kwargs)
+			except aiohttp.ClientResponseError as exc:
+				REQUEST_SECONDS.observe(time.perf_counter() - start, host=host)
+				RESPONSES.inc(host=host, status=exc.status)
+				limiter.update(exc.headers or {})
+				if exc.status not in RETRY_STATUSES or attempt >= max_retries:
+					raise
+				delay = retry_after(exc.headers or {})
+				if exc.status == HTTPStatus.TOO_MANY_REQUESTS:
+					# everything else going to this host would get the same response, so hold all of it back
+					limiter.pause(self._backoff(attempt) if delay is None else delay)
+					delay = 0
+			except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+				RESPONSES.inc(host=host, status='error')
+				if attempt >= max_retries:
+					raise
+				delay = None
+			else:
+				REQUEST_SECONDS.observe(time.perf_counter() - start, host=host)
+				RESPONSES.inc(host=host, status=resp.status)
+				limiter.update(resp.headers)
+				break
+
+			attempt += 1
+			self.retries += 1
+			RETRIES.inc(host=host)
+			# a server that says how long to wait knows better than max_backoff, which only caps our own guesses
+			await anyio.sleep(self._backoff(attempt) if delay is None else delay)
+
+		async with resp:
+			yield resp
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import sys
+import time
+import schema
+import extract
+import multiprocessing
+import concurrent.futures
+from third_party import utils
+
+# how many raw activities each job handles
+CHUNK_SIZE = 5000
+
+def parse_args():
+	parser = utils.arg_parser_factory(
+		description='Rebuild the posts table from the saved raw activities, without refetching anything.',
+	)
+	parser.add_argument(
+		'-j', '--jobs', type=int,
+		help='How many processes to use. Defaults to the number of CPUs.',
+	)
+	# argparse.BooleanOptionalAction would do this, but it needs Python 3.9
+	parser.add_argument(
+		'--fast', dest='fast', action='store_true', default=None,
+		help='Use the fast HTML parser. Defaults to the fast_html_extraction config setting.',
+	)
+	parser.add_argument(
+		'--no-fast', dest='fast', action='store_false',
+		help="Don't use the fast HTML parser.",
+	)
+	return parser.parse_args()
+
+def reextract_range(db_path, start, stop, fast):
+	"""return posts rows for the raw activities with rowid in [start, stop)"""
+	db = schema.connect(db_path)
+	try:
+		activities = [
+			extract.decompress_activity(activity)
+			for activity, in db.execute(
+				'SELECT activity FROM raw_activities WHERE rowid >= ? AND rowid < ?',
+				(start, stop),
+			)
+		]
+	finally:
+		db.close()
+
+	return [row for row, _ in extract.process_activities(activities, fast, keep_raw=False)]
+
+def reextract(cfg, *, jobs=None, fast=False):
+	"""rebuild every post that has a raw activity saved, returning how many were rebuilt"""
+	db = schema.connect(cfg['db_path'])
+	try:
+		if fast and (mismatches := extract.fast_path_mismatches()):
+			print('Fast HTML extraction disagrees with the usual extraction, not using it:', repr(mismatches[0]))
+			fast = False
+
+		max_rowid, = db.execute('SELECT coalesce(max(rowid), 0) FROM raw_activities').fetchone()
+		rebuilt = 0
+		with concurrent.futures.ProcessPoolExecutor(
+			max_workers=jobs or os.cpu_count(),
+			mp_context=multiprocessing.get_context('spawn'),
+		) as executor:
+			futures = [
+				executor.submit(reextract_range, cfg['db_path'], start, start + CHUNK_SIZE, fast)
+				for start in range(1, max_rowid + 1, CHUNK_SIZE)
+			]
+			for future in concurrent.futures.as_completed(futures):
+				rows = future.result()
+				with db:
+					db.executemany(
+						"""
+						UPDATE posts
+						-- the summary may have changed, so whether the post is learnable has to be worked out again
+						SET summary = ?2, content = ?3, published_at = ?4, learnable = NULL
+						WHERE post_id = ?1
+						""",
+						rows,
+					)
+				rebuilt += len(rows)
+				print(f'{rebuilt} posts re-extracted', end='\r', flush=True)
+	finally:
+		db.close()
+
+	print()
+	return rebuilt
+
+def main():
+	args = parse_args()
+	cfg = utils.load_config(args.cfg)
+	start = time.perf_counter()
+	rebuilt = reextract(cfg, jobs=args.jobs, fast=cfg['fast_html_extraction'] if args.fast is None else args.fast)
+	print(f'Re-extracted {rebuilt} posts in {time.perf_counter() - start:.1f}s')
+
+	if rebuilt and cfg['generation_mode'] is utils.TextGenerationMode.markov:
+		# the posts changed without the watermark noticing, so the model has to be built from scratch
+		from generators import markov
+		print('Rebuilding the markov model')
+		markov.update_model(cfg, rebuild=True)
+
+if __name__ == '__main__':
+	try:
+		main()
+	except KeyboardInterrupt:
+		sys.exit(1)
@@ -2,87 +2,347 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import re
+import sys
+import json
+import time
 import anyio
+import random
+import asyncio
+import aiohttp
+import metrics
 import pleroma
 import contextlib
+import collections
 from third_party import utils
+from utils import http_session_factory, following
+from generators import buffer
+from generators.pool import GeneratorPool
+
+# how many times to try getting a mention's thread before giving up on it
+MAX_CONTEXT_ATTEMPTS = 3
+# how many recent notification IDs to remember, to skip mentions that were already handled
+SEEN_NOTIFICATIONS = 1000
+NOTIFICATION_PAGE_SIZE = 40
+# seconds between pings, so that a connection that died quietly gets noticed and replaced
+STREAM_HEARTBEAT = 30
+MAX_STREAM_BACKOFF = 60
+# how many posts to remember the thread length of, and for how many seconds
+THREAD_LENGTH_CACHE_SIZE = 10000
+THREAD_LENGTH_CACHE_TTL = 24 * 60 * 60
+
+MENTIONS = metrics.counter('reply_mentions_total', 'Mentions received, not counting ones seen twice')
+HANDLED = metrics.counter(
+	'reply_handled_total',
+	'Mentions handled, by outcome: replied, command, thread_too_long, gave_up (on getting the thread) or error',
+	('result',),
+)
+REPLY_SECONDS = metrics.histogram('reply_seconds', 'Time from receiving a mention to posting the reply')
+CONTEXT_RETRIES = metrics.counter('reply_context_retries_total', 'Times getting a thread failed and was retried later')
+THREAD_LENGTH_CACHE = metrics.counter(
+	'reply_thread_length_cache_total', 'Thread length lookups, by whether the cache had the answer', ('result',),
+)
+STREAM_RECONNECTS = metrics.counter('reply_stream_reconnects_total', 'Times the notification stream was reconnected')
 
 def parse_args():
 	return utils.arg_parser_factory(description='Reply service. Leave running in the background.').parse_args()
 
+class ThreadLengthCache:
+	"""Remembers how many of the bot's posts are in the thread leading up to (and including) each of the bot's posts,
+	so that replying to a mention in a thread the bot is already in doesn't mean fetching the whole thread again.
+	"""
+
+	def __init__(self, *, size=THREAD_LENGTH_CACHE_SIZE, ttl=THREAD_LENGTH_CACHE_TTL):
+		self.size = size
+		self.ttl = ttl
+		# post ID: (bot posts, when it expires), least recently used first
+		self._lengths = collections.OrderedDict()
+
+	def get(self, post_id):
+		"""return the number of bot posts up to post_id, or None if it isn't known"""
+		try:
+			length, expires_at = self._lengths[post_id]
+		except KeyError:
+			THREAD_LENGTH_CACHE.inc(result='miss')
+			return None
+		if expires_at < time.monotonic():
+			# posts in the thread may have been deleted since
+			del self._lengths[post_id]
+			THREAD_LENGTH_CACHE.inc(result='miss')
+			return None
+		self._lengths.move_to_end(post_id)
+		THREAD_LENGTH_CACHE.inc(result='hit')
+		return length
+
+	def set(self, post_id, length):
+		self._lengths[post_id] = length, time.monotonic() + self.ttl
+		self._lengths.move_to_end(post_id)
+		if len(self._lengths) > self.size:
+			self._lengths.popitem(last=False)
+
 class ReplyBot:
 	def __init__(self, cfg):
 		self.cfg = cfg
 		self.pleroma = pleroma.Pleroma(access_token=cfg['access_token'], api_base_url=cfg['site'])
+		self._refilling = False
+		# thread key: (notification, failed attempts) not yet handled, for each thread a worker is on
+		self._threads = {}
+		self._seen = collections.OrderedDict()
+		self._last_notification_id = None
+		self._thread_lengths = ThreadLengthCache()
+		# notification ID: when it arrived, for mentions that haven't been handled yet
+		self._received_at = {}
 
 	async def run(self):
-		async with self.pleroma as self.pleroma:
+		async with contextlib.AsyncExitStack() as stack:
+			self.pleroma = await stack.enter_async_context(self.pleroma)
+			self._http = await stack.enter_async_context(http_session_factory())
+			self.generator = await stack.enter_async_context(GeneratorPool(self.cfg))
 			self.me = (await self.pleroma.me())['id']
-			self.follows = frozenset(user['id'] for user in await self.pleroma.following(self.me))
-			async for notification in self.pleroma.stream_mentions():
-				await self.process_notification(notification)
+			await self._load_follows()
+			# so that mentions that arrive while the stream is down, before it's sent anything, are caught up on too
+			self._last_notification_id = await self._latest_notification_id()
+			# the queue holds threads with mentions waiting, not the mentions themselves.
+			# a full queue makes the stream wait, rather than letting unanswered mentions pile up in memory.
+			self._tx, rx = anyio.create_memory_object_stream(self.cfg['reply_queue_size'])
+			async with anyio.create_task_group() as self._tg, self._tx, rx:
+				self._tg.start_soon(self._refresh_follows)
+				for _ in range(self.cfg['reply_concurrency']):
+					self._tg.start_soon(self._handle_threads, rx.clone())
+				async for notification in self._mentions():
+					await self._dispatch(notification)
 
-	async def process_notification(self, notification, retry_count=0):
-		acct = "@" + notification['account']['acct']  # get the account's @
-		post_id = notification['status']['id']
+	async def _load_follows(self):
+		self.follows = frozenset([
+			user['id'] async for user in following(self._http, self.cfg['site'], self.cfg['access_token'], self.me)
+		])
 
-		# catch HTTP 500 and backoff on requests
-		retry_count = retry_count + 1
-		try:
-			context = await self.pleroma.status_context(post_id)
-		except pleroma.BadResponse as exc:
-			if retry_count < 3:
-				await anyio.sleep(2**retry_count)
-				await self.process_notification(notification, retry_count)
+	async def _refresh_follows(self):
+		"""keep up with who the bot follows, since they're the ones allowed to use commands"""
+		while True:
+			await anyio.sleep(self.cfg['follows_refresh_interval'])
+			try:
+				await self._load_follows()
+			except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as exc:
+				# the old list will do until next time
+				print('Failed to refresh the follow list:', repr(exc), file=sys.stderr)
+
+	async def _mentions(self):
+		"""Yield mentions as they arrive, reconnecting whenever the stream drops.
+
+		After reconnecting, the mentions that came in while disconnected are fetched and yielded too.
+		"""
+		backoff = 1
+		while True:
+			try:
+				async with self._http.ws_connect(
+					self.pleroma.api_base_url + '/api/v1/streaming',
+					params=dict(stream='user:notification', access_token=self.pleroma.access_token),
+					heartbeat=STREAM_HEARTBEAT,
+				) as ws:
+					backoff = 1
+					# only now that the stream is connected can we be sure that nothing falls between the two
+					async for notification in self._missed_mentions():
+						yield notification
+
+					async for msg in ws:
+						if msg.type != aiohttp.WSMsgType.TEXT:
+							continue
+						try:
+							event = msg.json()
+							if event['event'] != 'notification':
+								continue
+							# don't ask me why the payload is also JSON encoded smh
+							notification = json.loads(event['payload'])
+							notification_id = notification['id']
+							is_mention = notification['type'] == 'mention' and 'status' in notification
+						except (ValueError, KeyError, TypeError) as exc:
+							# one garbled message isn't a reason to drop the connection, let alone stop
+							print('Skipping a malformed stream message:', repr(exc), repr(msg.data[:200]), file=sys.stderr)
+							continue
+						self._last_notification_id = notification_id
+						if is_mention:
+							yield notification
+			except (pleroma.BadResponse, aiohttp.ClientError, asyncio.TimeoutError) as exc:
+				print('Notification stream failed:', repr(exc), file=sys.stderr)
 			else:
-				# failed too many times in a row, logging
-				print(f"Received HTTP 500 {retry_count} times in a row, aborting reply attempt.")
+				print('Notification stream closed', file=sys.stderr)
+
+			await anyio.sleep(random.uniform(0, backoff))
+			backoff = min(MAX_STREAM_BACKOFF, backoff * 2)
+			STREAM_RECONNECTS.inc()
+
+	async def _notifications(self, **params):
+		notifications = await self.pleroma.request('GET', '/api/v1/notifications', params=params)
+		# pleroma.py only raises for 400 and 500. anything else that went wrong is an error object instead of a list.
+		if not isinstance(notifications, list):
+			raise pleroma.BadResponse(notifications)
+		return notifications
+
+	async def _latest_notification_id(self):
+		"""return the ID of the newest notification, or None if there aren't any"""
+		notifications = await self._notifications(limit=1)
+		return notifications[0]['id'] if notifications else None
+
+	async def _missed_mentions(self):
+		"""yield the mentions since the last notification seen, oldest first"""
+		params = dict(limit=NOTIFICATION_PAGE_SIZE)
+		# with no notifications seen at all, not even at startup, every notification there is now is new
+		if self._last_notification_id is not None:
+			params['min_id'] = self._last_notification_id
+		while notifications := await self._notifications(**params):
+			# each page is newest first, but starts right after min_id
+			self._last_notification_id = params['min_id'] = notifications[0]['id']
+			for notification in reversed(notifications):
+				if notification.get('type') == 'mention' and 'status' in notification:
+					yield notification
+
+	async def _dispatch(self, notification):
+		# mentions can show up twice, from the stream and from catching up after reconnecting
+		if notification['id'] in self._seen:
+			return
+		self._seen[notification['id']] = None
+		if len(self._seen) > SEEN_NOTIFICATIONS:
+			self._seen.popitem(last=False)
+		MENTIONS.inc()
+		self._received_at[notification['id']] = time.monotonic()
+
+		key = self.thread_key(notification['status'])
+		if (pending := self._threads.get(key)) is not None:
+			# a worker is on this thread already, or it's waiting to be retried. either way, it gets to this one next.
+			pending.append((notification, 0))
 			return
+		self._threads[key] = collections.deque([(notification, 0)])
+		await self._tx.send(key)
+
+	@staticmethod
+	def thread_key(status):
+		"""return something that's the same for every post in a thread"""
+		if (conversation_id := (status.get('pleroma') or {}).get('conversation_id')) is not None:
+			return conversation_id
+		# not knowing which thread the post is in, it's only ordered with respect to itself
+		return 'status', status['id']
+
+	async def _handle_threads(self, rx):
+		async with rx:
+			async for key in rx:
+				pending = self._threads[key]
+				while pending:
+					notification, attempts = pending.popleft()
+					try:
+						bot_posts = await self.bot_posts_in_thread(notification['status'])
+					except (pleroma.BadResponse, aiohttp.ClientError, asyncio.TimeoutError):
+						attempts += 1
+						if attempts < MAX_CONTEXT_ATTEMPTS:
+							# wait without holding up other threads, keeping this one's place so it stays in order
+							pending.appendleft((notification, attempts))
+							self._tg.start_soon(self._retry_thread, key, 2 ** attempts)
+							CONTEXT_RETRIES.inc()
+							break
+						print(f'Failed to get the thread of {notification["status"]["id"]} {attempts} times in a row, aborting reply attempt.')
+						HANDLED.inc(result='gave_up')
+						self._received_at.pop(notification['id'], None)
+						continue
+					except Exception:
+						# e.g. a 400 for the thread, which won't go away by trying again.
+						# either way, one bad mention shouldn't take down the whole service.
+						HANDLED.inc(result='error')
+						import traceback
+						traceback.print_exc()
+						self._received_at.pop(notification['id'], None)
+						continue
+
+					try:
+						await self.process_notification(notification, bot_posts)
+					except Exception:
+						HANDLED.inc(result='error')
+						# one bad mention shouldn't take down the whole service
+						import traceback
+						traceback.print_exc()
+					finally:
+						self._received_at.pop(notification['id'], None)
+				else:
+					del self._threads[key]
+
+	async def _retry_thread(self, key, delay):
+		await anyio.sleep(delay)
+		await self._tx.send(key)
+
+	async def bot_posts_in_thread(self, status):
+		"""return how many of the bot's posts are in the thread leading up to status"""
+		# a mention that replies to one of the bot's posts usually replies to one the bot just made
+		if (in_reply_to_id := status['in_reply_to_id']) is not None and (
+			bot_posts := self._thread_lengths.get(in_reply_to_id)
+		) is not None:
+			return bot_posts
+
+		context = await self.pleroma.status_context(status['id'])
+		bot_posts = 0
+		for post in context['ancestors']:
+			if post['account']['id'] == self.me:
+				bot_posts += 1
+				# the ancestors are in order, so this is the thread length for each of them too
+				self._thread_lengths.set(post['id'], bot_posts)
+		return bot_posts
 
+	async def process_notification(self, notification, bot_posts):
 		# check if we've already been participating in this thread
-		if self.check_thread_length(context):
+		if self.check_thread_length(bot_posts):
+			HANDLED.inc(result='thread_too_long')
 			return
 
 		content = self.extract_toot(notification['status']['content'])
 		if content in {'pin', 'unpin'}:
-			await self.process_command(context, notification, content)
+			await self.process_command(notification, content)
+			HANDLED.inc(result='command')
 		else:
-			await self.reply(notification)
+			await self.reply(notification, bot_posts)
+			HANDLED.inc(result='replied')
 
-	def check_thread_length(self, context) -> bool:
+	def check_thread_length(self, bot_posts) -> bool:
 		"""return whether the thread is too long to reply to"""
-		posts = 0
-		for post in context['ancestors']:
-			if post['account']['id'] == self.me:
-				posts += 1
-			if posts >= self.cfg['max_thread_length']:
-				return True
+		return bot_posts >= self.cfg['max_thread_length']
 
-		return False
-
-	async def process_command(self, context, notification, command):
+	async def process_command(self, notification, command):
 		post_id = notification['status']['id']
 		if notification['account']['id'] not in self.follows: # this user is unauthorized
 			await self.pleroma.react(post_id, '❌')
 			return
 
-		# find the post the user is talking about
-		for post in context['ancestors']:
-			if post['id'] == notification['status']['in_reply_to_id']:
-				target_post_id = post['id']
+		# the post the user is talking about
+		if (target_post_id := notification['status']['in_reply_to_id']) is None:
+			await self._command_failed(notification, f'reply to the post you want me to {command}')
+			return
 
 		try:
 			await (self.pleroma.pin if command == 'pin' else self.pleroma.unpin)(target_post_id)
 		except pleroma.BadRequest as exc:
-			async with anyio.create_task_group() as tg:
-				tg.start_soon(self.pleroma.react, post_id, '❌')
-				tg.start_soon(self.pleroma.reply, notification['status'], 'Error: ' + exc.args[0])
+			await self._command_failed(notification, exc.args[0])
 		else:
 			await self.pleroma.react(post_id, '✅')
 
-	async def reply(self, notification):
-		toot = await utils.make_post(self.cfg)  # generate a toot
-		await self.pleroma.reply(notification['status'], toot, cw=self.cfg['cw'])
+	async def _command_failed(self, notification, error):
+		async with anyio.create_task_group() as tg:
+			tg.start_soon(self.pleroma.react, notification['status']['id'], '❌')
+			tg.start_soon(self.pleroma.reply, notification['status'], 'Error: ' + error)
+
+	async def reply(self, notification, bot_posts):
+		toot = await utils.make_post(self.cfg, mode=self.generator.mode, pool=self.generator)  # generate a toot
+		status = await self.pleroma.reply(notification['status'], toot, cw=self.cfg['cw'])
+		self._thread_lengths.set(status['id'], bot_posts + 1)
+		if (received_at := self._received_at.get(notification['id'])) is not None:
+			REPLY_SECONDS.observe(time.monotonic() - received_at)
+		if not self._refilling:
+			self._refilling = True
+			self._tg.start_soon(self._refill_buffer)
+
+	async def _refill_buffer(self):
+		try:
+			await buffer.refill(self.cfg, self.generator.mode, pool=self.generator)
+		except Exception:
+			import traceback
+			traceback.print_exc()
+		finally:
+			self._refilling = False
 
 	@staticmethod
 	def extract_toot(toot):
@@ -94,7 +354,8 @@ class ReplyBot:
 async def amain():
 	args = parse_args()
 	cfg = utils.load_config(args.cfg)
-	await ReplyBot(cfg).run()
+	async with metrics.reporting(cfg):
+		await ReplyBot(cfg).run()
 
 if __name__ == '__main__':
 	with contextlib.suppress(KeyboardInterrupt):
@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# schema.sql is version 1. every later version is a file in migrations/ named after the version it migrates to,
+# e.g. migrations/0002_generated_posts.sql
+
+import sqlite3
+import functools
+from pathlib import Path
+
+SCHEMA_PATH = Path(__file__).parent / 'schema.sql'
+# run on every connection. WAL lets generators read while the fetcher writes,
+# and with WAL, synchronous=NORMAL is still safe against corruption, it just might lose the last commit on power loss.
+PRAGMAS = [
+	'PRAGMA journal_mode = WAL',
+	'PRAGMA synchronous = NORMAL',
+	'PRAGMA temp_store = MEMORY',
+	# in KiB when negative
+	'PRAGMA cache_size = -65536',
+	'PRAGMA busy_timeout = 10000',
+]
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+
+# the migrations can't change while we're running, and globbing for them on every connection adds up
+@functools.lru_cache(maxsize=None)
+def migrations():
+	"""return a sorted list of (version, path) for every migration after version 1"""
+	return sorted((int(path.name.partition('_')[0]), path) for path in MIGRATIONS_DIR.glob('*.sql'))
+
+def latest_version():
+	return max((version for version, _ in migrations()), default=1)
+
+def current_version(db):
+	try:
+		row = db.execute('SELECT migration_version FROM migrations').fetchone()
+	except sqlite3.OperationalError:
+		# the migrations table doesn't exist, so the schema has never been run
+		return None
+	# the table existing at all means that the schema has been run
+	return row[0] if row else 1
+
+def _statements(script):
+	"""split an SQL script into individual statements, since executescript can't run inside a transaction"""
+	statement = ''
+	for line in script.splitlines(keepends=True):
+		statement += line
+		if sqlite3.complete_statement(statement):
+			yield statement
+			statement = ''
+
+def migrate(db):
+	"""bring db, a sqlite3 connection, up to the latest schema version"""
+	if current_version(db) == latest_version():
+		return
+
+	isolation_level, db.isolation_level = db.isolation_level, None
+	try:
+		# IMMEDIATE takes the write lock right away, so that when several processes open an outdated DB at once,
+		# the others wait and then see that the first one already migrated it
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			if (version := current_version(db)) is None:
+				for statement in _statements(SCHEMA_PATH.read_text()):
+					db.execute(statement)
+				db.execute('INSERT INTO migrations (migration_version) VALUES (1)')
+				version = 1
+
+			for to_version, path in migrations():
+				if to_version <= version: continue
+				for statement in _statements(path.read_text()):
+					db.execute(statement)
+				db.execute('UPDATE migrations SET migration_version = ?', (to_version,))
+		except BaseException:
+			db.execute('ROLLBACK')
+			raise
+		db.execute('COMMIT')
+	finally:
+		db.isolation_level = isolation_level
+
+def connect(db_path):
+	"""open the posts DB, migrating it if necessary"""
+	db = sqlite3.connect(db_path)
+	db.text_factory = str
+	for pragma in PRAGMAS:
+		db.execute(pragma)
+	migrate(db)
+	return db
@@ -0,0 +1,8 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import sys
+from pathlib import Path
+
+# the scripts and modules being tested live at the top of the repo, not in a package
+REPO = Path(__file__).parent.parent
+sys.path.insert(0, str(REPO))
@@ -0,0 +1,63 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# gen.py the way cron runs it: a fresh process, from start to posted status, against fake_instance.py
+
+import sys
+import json
+import time
+import anyio
+import bench
+import shutil
+import socket
+import pytest
+from fake_instance import FakeInstance
+from generators import markov
+from third_party import utils
+
+REPO = bench.REPO
+CORPUS_SIZE = 2000
+# the budgets are for the slowest run in bench.py, but the fastest here, so that a busy CI machine doesn't fail them
+RUNS = 3
+
+@pytest.fixture
+def anyio_backend():
+	return 'asyncio'
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+@pytest.fixture
+def bot_dir(tmp_path, monkeypatch):
+	"""a directory to run gen.py in, with a corpus whose model is already built, as fetch_posts.py leaves it"""
+	shutil.copy(REPO / 'config.defaults.json', tmp_path)
+	bench.make_corpus(tmp_path / 'posts.db', CORPUS_SIZE)
+	monkeypatch.chdir(tmp_path)
+	return tmp_path
+
+async def run_gen(*args):
+	start = time.perf_counter()
+	proc = await anyio.run_process([sys.executable, str(REPO / 'gen.py'), '-c', 'config.json', *args], check=False)
+	assert proc.returncode == 0, proc.stderr.decode()
+	return time.perf_counter() - start
+
+@pytest.mark.anyio
+async def test_posts_within_budget(bot_dir):
+	async with FakeInstance(port=free_port()) as instance:
+		with open(bot_dir / 'config.json', 'w') as f:
+			json.dump(dict(site=instance.site, access_token='test', db_path=str(bot_dir / 'posts.db')), f)
+		await anyio.to_thread.run_sync(markov.update_model, utils.load_config('config.json'))
+
+		runs = []
+		for i in range(RUNS):
+			runs.append(await run_gen())
+			assert len(instance.statuses) == i + 1
+			assert instance.statuses[-1]['content'].strip()
+
+	assert min(runs) <= bench.POST_BUDGET_SECONDS, f'gen.py took {min(runs):.2f}s to post at best'
+
+@pytest.mark.anyio
+async def test_import_within_budget():
+	seconds = min([await bench.import_seconds('gen') for _ in range(RUNS)])
+	assert seconds * 1000 <= bench.IMPORT_BUDGET_MS, f'importing gen took {seconds * 1000:.0f}ms at best'
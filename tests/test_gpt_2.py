@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# the gpt_2 generation mode, with a tiny randomly initialised model built on the spot, so that nothing is downloaded
+
+import os
+import json
+import pytest
+from pathlib import Path
+
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+tokenizers = pytest.importorskip('tokenizers')
+
+from generators import gpt_2
+
+REPO = Path(__file__).parent.parent
+
+END_OF_TEXT = '<|endoftext|>'
+
+@pytest.fixture(scope='module')
+def tiny_model(tmp_path_factory):
+	"""the path to a GPT-2 with one layer and a byte-level BPE tokenizer with a few hundred tokens"""
+	path = tmp_path_factory.mktemp('tiny_gpt_2')
+	tokenizer = tokenizers.Tokenizer(tokenizers.models.BPE())
+	tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+	tokenizer.decoder = tokenizers.decoders.ByteLevel()
+	tokenizer.train_from_iterator(
+		['the quick brown fox jumps over the lazy dog'] * 20,
+		tokenizers.trainers.BpeTrainer(
+			vocab_size=300,
+			special_tokens=[END_OF_TEXT],
+			initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet(),
+		),
+	)
+	tokenizer = transformers.PreTrainedTokenizerFast(
+		tokenizer_object=tokenizer, bos_token=END_OF_TEXT, eos_token=END_OF_TEXT,
+	)
+	tokenizer.save_pretrained(path)
+
+	torch.manual_seed(0)
+	transformers.GPT2LMHeadModel(transformers.GPT2Config(
+		vocab_size=len(tokenizer),
+		n_positions=128,
+		n_embd=32,
+		n_layer=1,
+		n_head=2,
+		bos_token_id=tokenizer.bos_token_id,
+		eos_token_id=tokenizer.eos_token_id,
+	)).save_pretrained(path)
+	return path
+
+@pytest.fixture
+def cfg(tiny_model, monkeypatch):
+	with open(REPO / 'config.defaults.json') as f:
+		cfg = json.load(f)
+	cfg.update(gpt_2_model=str(tiny_model), gpt_2_batch_size=4, gpt_2_max_tokens=16)
+	# every test starts with nothing loaded, and leaves torch's thread count as it found it
+	monkeypatch.setattr(gpt_2, '_resident', None)
+	threads = torch.get_num_threads()
+	torch.manual_seed(0)
+	yield cfg
+	torch.set_num_threads(threads)
+
+@pytest.fixture
+def generated(monkeypatch):
+	"""the output of every model.generate call, as token IDs"""
+	outputs = []
+	generate = transformers.GPT2LMHeadModel.generate
+
+	def spy(self, *args, **kwargs):
+		output = generate(self, *args, **kwargs)
+		outputs.append(output)
+		return output
+
+	monkeypatch.setattr(transformers.GPT2LMHeadModel, 'generate', spy)
+	return outputs
+
+def test_batched_generation(cfg, generated):
+	sentences = gpt_2.make_sentences(cfg, 6)
+	assert 0 < len(sentences) <= 6
+	assert all(isinstance(sentence, str) and sentence for sentence in sentences)
+	# at most 4 at a time, so it takes at least two batches
+	assert len(generated) >= 2
+	assert len(generated[0]) == 4
+	assert all(len(output) <= 4 for output in generated)
+
+def test_token_cap(cfg, generated):
+	cfg['gpt_2_max_tokens'] = 5
+	gpt_2.make_sentences(cfg, 4)
+	# the start token, then at most gpt_2_max_tokens more
+	assert generated and all(output.shape[1] <= 1 + 5 for output in generated)
+
+def test_thread_count(cfg):
+	cfg['gpt_2_threads'] = 1
+	gpt_2.make_sentence(cfg)
+	assert torch.get_num_threads() == 1
+
+def test_warm_start(cfg, monkeypatch):
+	loads = []
+	from_pretrained = gpt_2.AutoModelForCausalLM.from_pretrained
+
+	def counting(*args, **kwargs):
+		loads.append(args)
+		return from_pretrained(*args, **kwargs)
+
+	monkeypatch.setattr(gpt_2.AutoModelForCausalLM, 'from_pretrained', counting)
+	gpt_2.warm_up(cfg)
+	for _ in range(3):
+		gpt_2.make_sentence(cfg)
+	gpt_2.make_sentences(cfg, 5)
+	assert len(loads) == 1
+
+	# a different thread count is a different setup, so that does load it again
+	cfg['gpt_2_threads'] = 1
+	gpt_2.make_sentence(cfg)
+	assert len(loads) == 2
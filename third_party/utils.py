@@ -1,20 +1,16 @@
 # SPDX-License-Identifier: MPL-2.0
 
+# gen.py runs from cron, so everything it imports is paid for on every post.
+# anything only some paths need (bs4, json5, the generators) is imported where it's used.
+
 import re
 import os
 import sys
-import html
+import copy
 import enum
 import json
-import shutil
-import sqlite3
+import anyio
 import argparse
-import itertools
-import json5 as json
-import multiprocessing
-import anyio.to_process
-from random import randint
-from bs4 import BeautifulSoup
 
 TextGenerationMode = enum.Enum('TextGenerationMode', """
 	markov
@@ -32,12 +28,29 @@ def arg_parser_factory(*, description):
 def parse_args(*, description):
 	return arg_parser_factory(description=description).parse_args()
 
-def load_config(cfg_path):
-	with open('config.defaults.json') as f:
-		cfg = json.load(f)
+# (absolute path, mtime, size): what the file parsed to
+_parsed = {}
+
+def _load_json(path):
+	"""parse a JSON5 file, only the first time it's loaded in this process, unless it changed since"""
+	st = os.stat(path)
+	key = os.path.abspath(path), st.st_mtime_ns, st.st_size
+	if (parsed := _parsed.get(key)) is None:
+		with open(path) as f:
+			text = f.read()
+		try:
+			# most configs are plain JSON, which the json module parses far faster, and without importing json5
+			parsed = json.loads(text)
+		except ValueError:
+			import json5
+			parsed = json5.loads(text)
+		_parsed[key] = parsed
+	# callers are free to change what they get
+	return copy.deepcopy(parsed)
 
-	with open(cfg_path) as f:
-		cfg.update(json.load(f))
+def load_config(cfg_path):
+	cfg = _load_json('config.defaults.json')
+	cfg.update(_load_json(cfg_path))
 
 	if not cfg['site'].startswith('https://') and not cfg['site'].startswith('http://'):
 		print("Site must begin with 'https://' or 'http://'. Value '{0}' is invalid - try 'https://{0}' instead.".format(cfg['site']), file=sys.stderr)
@@ -63,15 +76,25 @@ def remove_mentions(cfg, sentence):
 
 	return sentence
 
-async def make_post(cfg, *, mode=TextGenerationMode.markov):
+async def make_post(cfg, *, mode=TextGenerationMode.markov, pool=None):
+	from generators import buffer
+	if (sentence := await anyio.to_thread.run_sync(buffer.pop, cfg, mode)) is not None:
+		return sentence
+
+	if pool is not None:
+		return await pool.make_sentence()
+
 	if mode is TextGenerationMode.markov:
 		from generators.markov import make_sentence
 	elif mode is TextGenerationMode.gpt_2:
 		from generators.gpt_2 import make_sentence
 
-	return await anyio.to_process.run_sync(make_sentence, cfg)
+	# with no pool to keep a model loaded, a worker process would only be started to load it once, and import
+	# everything all over again first. a thread in this process is cheaper, and keeps the event loop free.
+	return await anyio.to_thread.run_sync(make_sentence, cfg)
 
 def extract_post_content(text):
+	from bs4 import BeautifulSoup
 	soup = BeautifulSoup(text, "html.parser")
 	for el in soup.select('br'):  # replace <br> with linebreak
 		el.replace_with('\n')
@@ -4,6 +4,7 @@ import sys
 import anyio
 import aiohttp
 import contextlib
+from yarl import URL
 from functools import wraps
 
 def as_corofunc(f):
@@ -36,14 +37,43 @@ def removeprefix(s, prefix):
 		# compatibility for pre-3.9
 		return s[len(prefix):] if s.startswith(prefix) else s
 
-def http_session_factory(headers={}, **kwargs):
+def http_session_factory(
+	headers={},
+	*,
+	connection_limit=100,
+	connection_limit_per_host=0,
+	dns_cache_ttl=10,
+	keepalive_timeout=15,
+	**kwargs,
+):
+	"""create an aiohttp session. 0 for either connection limit means no limit."""
 	py_version = '.'.join(map(str, sys.version_info))
 	user_agent = (
 		'pleroma-ebooks (https://github.com/ioistired/pleroma-ebooks); '
 		f'aiohttp/{aiohttp.__version__}; '
 		f'python/{py_version}'
 	)
+	connector = aiohttp.TCPConnector(
+		limit=connection_limit,
+		limit_per_host=connection_limit_per_host,
+		ttl_dns_cache=dns_cache_ttl,
+		keepalive_timeout=keepalive_timeout,
+	)
 	return aiohttp.ClientSession(
 		headers={'User-Agent': user_agent, **headers},
+		connector=connector,
 		**kwargs,
 	)
+
+async def following(http, site, access_token, account_id):
+	"""yield every account that account_id follows.
+	http is anything with an aiohttp-style request() that can be used as an async context manager.
+	"""
+	# pleroma.py doesn't expose the Link header, so it can only get the first page
+	url = URL(site) / 'api/v1/accounts' / account_id / 'following' % {'limit': 80}
+	headers = {'Authorization': 'Bearer ' + access_token}
+	while url is not None:
+		async with http.request('GET', url, headers=headers, raise_for_status=True) as resp:
+			for acc in await resp.json():
+				yield acc
+			url = resp.links.get('next', {}).get('url')